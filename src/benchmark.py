@@ -0,0 +1,461 @@
+'''
+Offline benchmarks for the hot paths of the OpenLibrary utilities.
+
+All fixtures are synthetic (gzipped ABBYY FineReader XML, MARC XML,
+binary _meta.mrc records and IA _files.xml listings), generated into a
+temporary directory, so no network access is needed.
+
+The stream and fast processfile cases first check that their results
+match the dom engine's on a few fixtures; if any check fails the run exits
+with an error.
+
+The update_marc_record case imports olmarcdecorator, which is a Python 2
+script, so it is skipped when run under Python 3.
+
+Usage: python benchmark.py [--repeat N] [--pages N] [--chars N] [--records N] [case ...]
+'''
+from __future__ import print_function
+
+import argparse
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+STUB_LATENCY = 0.02 # seconds per stub server response
+ABBYY_NS = 'http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml'
+FIELDS = ['583', '596', '852', '856', '699', '790']
+CHECK_FILES = 3 # extra ABBYY fixtures the faster engines are checked against
+
+CASES = []
+STUB_SERVERS = []
+
+
+class CheckFailed(Exception):
+    '''Raised by a case whose results don't match the reference implementation'''
+
+
+def case(name):
+    '''Register a benchmark case.  The function is called with the parsed args
+    and the fixture directory and returns (setup, run, count, unit), or raises
+    CheckFailed.'''
+    def register(func):
+        CASES.append((name, func))
+        return func
+    return register
+
+
+# Fixture generators
+
+def make_abbyy(filename, pages=10, chars=2000, seed=0):
+    '''Write a gzipped ABBYY FineReader file with random char attributes'''
+    rnd = random.Random(seed)
+    with gzip.open(filename, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(('<document xmlns="%s" version="1.0" pagesCount="%d">\n' % (ABBYY_NS, pages)).encode('ascii'))
+        for _ in range(pages):
+            f.write(b'<page width="2500" height="3500" resolution="400" originalCoords="true">\n')
+            f.write(b'<block blockType="Text"><text><par><line baseline="100" l="0" t="0" r="100" b="100">\n')
+            word_start = True
+            for _ in range(chars):
+                if word_start:
+                    attrs = ' wordStart="true" wordFromDictionary="%s" wordNormal="true" wordNumeric="false" wordIdentifier="false" wordPenalty="%d"' % (
+                        rnd.choice(('true', 'true', 'true', 'false')), rnd.choice((0, 0, 0, 6, 36)))
+                else:
+                    attrs = ' wordStart="false" wordFromDictionary="false" wordNormal="false"'
+                if rnd.random() < 0.03:
+                    attrs += ' suspicious="true"'
+                text = ' ' if rnd.random() < 0.15 else rnd.choice('abcdefghijklmnopqrstuvwxyz&')
+                word_start = text == ' '
+                f.write(('<charParams l="%d" t="10" r="%d" b="40" charConfidence="%d"%s>%s</charParams>\n' % (
+                    rnd.randint(0, 2000), rnd.randint(0, 2000), rnd.randint(0, 100), attrs,
+                    '&amp;' if text == '&' else text)).encode('ascii'))
+            f.write(b'</line></par></text></block>\n</page>\n')
+        f.write(b'</document>\n')
+
+
+def subfields(*values):
+    '''Subfields in the form the installed pymarc expects (flat list before 5.0)'''
+    import pymarc
+    if hasattr(pymarc, 'Subfield'):
+        return [pymarc.Subfield(values[n], values[n + 1]) for n in range(0, len(values), 2)]
+    return list(values)
+
+
+def make_marc_record(i, seed=0):
+    '''Build a pymarc Record resembling an IA _archive_marc.xml record'''
+    import pymarc
+    rnd = random.Random(seed + i)
+    record = pymarc.Record()
+    year = rnd.randint(1850, 1922)
+    record.add_field(pymarc.Field(tag='001', data='ocm%08d' % i))
+    record.add_field(pymarc.Field(tag='008', data='850101s%4d    nyu           000 1 eng d' % year))
+    record.add_field(pymarc.Field(tag='100', indicators=['1', ' '],
+                                  subfields=subfields('a', 'Author %d,' % i, 'd', '1800-1900.')))
+    record.add_field(pymarc.Field(tag='245', indicators=['1', '0'],
+                                  subfields=subfields('a', 'Synthetic title %d /' % i, 'c', 'by Author %d.' % i)))
+    record.add_field(pymarc.Field(tag='260', indicators=[' ', ' '],
+                                  subfields=subfields('a', 'New York :', 'b', 'Publisher,', 'c', str(year))))
+    for tag in FIELDS:
+        for _ in range(rnd.randint(0, 2)):
+            record.add_field(pymarc.Field(tag=tag, indicators=['4', '0'],
+                                          subfields=subfields('a', 'remove me', 'u', 'http://example.org/%d' % i)))
+    record.add_field(pymarc.Field(tag='650', indicators=[' ', '0'], subfields=subfields('a', 'Fiction.')))
+    return record
+
+
+def make_marc_xml(filename, records):
+    import pymarc
+    with open(filename, 'wb') as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+        for record in records:
+            f.write(pymarc.record_to_xml(record))
+            f.write(b'\n')
+        f.write(b'</collection>\n')
+
+
+def make_files_xml(filename, ia, nfiles=30, seed=0):
+    '''Write an IA _files.xml listing with the usual derivative formats'''
+    rnd = random.Random(seed)
+    suffixes = ['.pdf', '_djvu.txt', '_djvu.xml', '.epub', '_abbyy.gz', '_meta.mrc', '_marc.xml',
+                '_meta.xml', '_files.xml', '_archive_marc.xml', '_jp2.zip', '_scandata.xml']
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<files>\n')
+        for n in range(nfiles):
+            suffix = suffixes[n] if n < len(suffixes) else '_%04d.jpg' % n
+            f.write('  <file name="%s%s" source="derivative"><format>%s</format><size>%d</size></file>\n' % (
+                ia, suffix, suffix.split('.')[-1], rnd.randint(1000, 10 ** 8)))
+        f.write('</files>\n')
+
+
+# Local stub HTTP server
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Answers every GET with a small JSON body after STUB_LATENCY seconds'''
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1 # send headers and body together, avoiding delayed ACK stalls
+
+    def do_GET(self):
+        time.sleep(STUB_LATENCY)
+        body = ('{"key": "%s"}' % self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MarcHandler(StubHandler):
+    '''Serves MARC records by path, honouring "Range: bytes=0-N" if use_range is set'''
+    records = {}
+    use_range = True
+
+    def do_GET(self):
+        body = self.records[self.path]
+        status = 200
+        byte_range = self.headers.get('Range')
+        if self.use_range and byte_range and byte_range.startswith('bytes=0-'):
+            body = body[:int(byte_range[len('bytes=0-'):]) + 1]
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub_server(handler=StubHandler):
+    '''Start a stub server on a free localhost port and return it'''
+    server = ThreadingServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    STUB_SERVERS.append(server)
+    return server
+
+
+# Cases
+
+def engine_case(engine):
+    def abbyy_case(args, fixtures):
+        import iaabbyqa
+        filename = os.path.join(fixtures, 'synthetic_abbyy.gz')
+        if not os.path.exists(filename):
+            make_abbyy(filename, args.pages, args.chars)
+        if engine != 'dom':
+            # Check the faster engines still agree with the original one, on a few smaller files too
+            corpus = [filename]
+            for seed in range(1, CHECK_FILES + 1):
+                corpus.append(os.path.join(fixtures, 'synthetic_abbyy_%d.gz' % seed))
+                if not os.path.exists(corpus[-1]):
+                    make_abbyy(corpus[-1], 3, args.chars // 2, seed)
+            for f in corpus:
+                if iaabbyqa.processfile(f, engine) != iaabbyqa.processfile(f, 'dom'):
+                    raise CheckFailed('%s engine results differ from dom engine for %s'
+                                      % (engine, os.path.basename(f)))
+        return None, lambda _: iaabbyqa.processfile(filename, engine), args.pages * args.chars, 'chars'
+    return abbyy_case
+
+for _engine in ('dom', 'stream', 'fast'):
+    case('processfile-%s' % _engine)(engine_case(_engine))
+
+
+@case('update_marc_record')
+def update_marc_case(args, fixtures):
+    import pymarc
+    import olmarcdecorator
+    from olclient import ShortURLStore, StubShortener, shorten_all
+    urls = lambda i: (olmarcdecorator.EPUB_URL % ('ia%d' % i, 'ia%d' % i),
+                      olmarcdecorator.KINDLE_URL % ('ia%d' % i, 'ia%d' % i),
+                      'http://openlibrary.org/books/OL%dM' % i)
+    # Don't call out to bit.ly, and time a re-run, with the short URLs already stored
+    olmarcdecorator.shortener = StubShortener()
+    olmarcdecorator.url_store = ShortURLStore(os.path.join(fixtures, 'shorturls-update.sqlite'))
+    shorten_all([url for i in range(args.records) for url in urls(i)],
+                olmarcdecorator.shortener, olmarcdecorator.url_store)
+    filename = os.path.join(fixtures, 'synthetic_archive_marc.xml')
+    make_marc_xml(filename, [make_marc_record(i) for i in range(args.records)])
+
+    def setup():
+        return pymarc.parse_xml_to_array(filename)
+
+    def run(records):
+        for i, record in enumerate(records):
+            olmarcdecorator.update_marc_record(record, 'ia%d' % i, urls(i)[2])
+    return setup, run, args.records, 'records'
+
+
+@case('marc_transform')
+def marc_transform_case(args, fixtures):
+    import pymarc
+    from olclient import RecordTransform
+    filename = os.path.join(fixtures, 'synthetic_archive_marc.xml')
+    make_marc_xml(filename, [make_marc_record(i) for i in range(args.records)])
+    transform = RecordTransform({
+        'remove': FIELDS,
+        'add': [{'tag': '856', 'indicators': '40', 'subfields': [('u', '{url}'), ('z', 'Always available eBooks')]},
+                {'tag': '490', 'indicators': '1 ', 'subfields': [('a', 'Rediscover the classics')]},
+                {'tag': '655', 'indicators': ' 4', 'subfields': [('a', 'Electronic books.')]},
+                {'tag': '830', 'indicators': ' 0', 'subfields': [('a', 'Rediscover the classics.')]}],
+    })
+
+    def setup():
+        return pymarc.parse_xml_to_array(filename)
+
+    def run(records):
+        for i, record in enumerate(records):
+            transform(record, url='http://short.invalid/%d' % i)
+    return setup, run, args.records, 'records'
+
+
+@case('shorten_all')
+def shorten_case(args, fixtures):
+    from olclient import ShortURLStore, StubShortener, shorten_all
+    # Three URLs per record, each listed twice, and half already in the store
+    urls = ['https://archive.org/download/ia%d/ia%d.epub' % (i, i) for i in range(args.records)]
+    urls += ['http://openlibrary.org/books/OL%dM' % i for i in range(args.records)]
+    urls += ['https://www.amazon.com/gp/digital/fiona/web-to-kindle?clientid=IA&itemid=ia%d' % i
+             for i in range(args.records)]
+    urls += urls
+    shortener = StubShortener()
+    known = [(url, shortener(url)) for url in urls[:len(urls) // 4]]
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        store = ShortURLStore(os.path.join(fixtures, 'shorturls%d.sqlite' % counter[0]))
+        store.put_many(known, 'fixture')
+        return store
+
+    def run(store):
+        shorten_all(urls, shortener, store)
+    return setup, run, len(urls), 'URLs'
+
+
+@case('marc_year_language')
+def marc_008_case(args, fixtures):
+    from olclient import marc_year_language
+    records = [make_marc_record(i).as_marc() for i in range(args.records)]
+
+    def run(_):
+        for content in records:
+            marc_year_language(content)
+    return None, run, args.records, 'records'
+
+
+def probe_case(use_range):
+    def stub_probe_case(args, fixtures):
+        import requests
+        from olclient import mount_rate_limiter
+        from olclient import marc
+        # Pad the records out to a realistic size with extra notes
+        import pymarc
+        records = []
+        for i in range(args.requests):
+            record = make_marc_record(i)
+            for n in range(40):
+                record.add_field(pymarc.Field(tag='500', indicators=[' ', ' '], subfields=subfields('a', 'Note %d ' % n * 10)))
+            records.append(record.as_marc())
+        MarcHandler.records = dict(('/download/ia%d/ia%d_meta.mrc' % (i, i), r) for i, r in enumerate(records))
+        MarcHandler.use_range = use_range
+        server = start_stub_server(MarcHandler)
+        base = 'http://127.0.0.1:%d' % server.server_address[1]
+        session = requests.Session()
+        mount_rate_limiter(session, default=1000.0)
+
+        def run(_):
+            for i in range(args.requests):
+                marc.probe_field(base + '/download/ia%d/ia%d_meta.mrc' % (i, i), '008', session)
+        return None, run, args.requests, 'records'
+    return stub_probe_case
+
+case('probe_008-range')(probe_case(True))
+case('probe_008-norange')(probe_case(False))
+
+
+def files_case(indexed):
+    def listing_case(args, fixtures):
+        from olclient import find_file, get_files, get_store, item_file
+        ids = ['synthetic%05d' % i for i in range(args.records)]
+        for n, ia in enumerate(ids):
+            make_files_xml(os.path.join(fixtures, ia + '_files.xml'), ia, seed=n)
+        # Bulk imports the _files.xml fixtures
+        get_store(fixtures)
+
+        def run(_):
+            for ia in ids:
+                if indexed:
+                    item_file(ia, '_abbyy.gz', fixtures)
+                    item_file(ia, '_meta.mrc', fixtures)
+                else:
+                    files = get_files(ia, fixtures)
+                    find_file(files, '_abbyy.gz')
+                    find_file(files, '_meta.mrc')
+        return None, run, args.records, 'items'
+    return listing_case
+
+case('get_files+find_file')(files_case(False))
+case('item_file')(files_case(True))
+
+
+def fetch_case(workers):
+    def stub_fetch_case(args, fixtures):
+        import requests
+        from olclient import fetch_all, mount_rate_limiter
+        server = start_stub_server()
+        base = 'http://127.0.0.1:%d' % server.server_address[1]
+        urls = ['%s/books/OL%dM.json' % (base, i) for i in range(args.requests)]
+        session = requests.Session()
+        # High enough not to throttle; this measures latency overlap
+        mount_rate_limiter(session, default=1000.0, workers=workers)
+
+        def run(_):
+            fetch_all(lambda url: session.get(url).json(), urls, workers)
+        return None, run, args.requests, 'requests'
+    return stub_fetch_case
+
+case('fetch-serial')(fetch_case(1))
+case('fetch-concurrent')(fetch_case(8))
+
+
+def count_case(count_only):
+    def recentchanges_count_case(args, fixtures):
+        import json
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'olstats'))
+        from recentchanges import CHUNK_SIZE, count_array
+        rand = random.Random(0)
+        # One page of synthetic add-book changes
+        changes = [{'id': str(i), 'kind': 'add-book', 'timestamp': '2018-11-30T12:00:%02d.000000' % (i % 60),
+                    'comment': 'Added "%s" {%d}' % ('x' * rand.randint(5, 40), i), 'bot': False,
+                    'author': {'key': '/people/user%d' % rand.randint(0, 1000)}, 'ip': None, 'data': {},
+                    'changes': [{'key': '/books/OL%dM' % i, 'revision': 1},
+                                {'key': '/works/OL%dW' % i, 'revision': 1}]}
+                   for i in range(1000)]
+        page = json.dumps(changes).encode('utf-8')
+        pages = args.records // 10 or 1
+
+        def run(_):
+            for _ in range(pages):
+                if count_only:
+                    count_array(page[i:i + CHUNK_SIZE] for i in range(0, len(page), CHUNK_SIZE))
+                else:
+                    len(json.loads(page.decode('utf-8')))
+        return None, run, pages * len(page) / 1024.0 ** 2, 'MB'
+    return recentchanges_count_case
+
+case('count-parse')(count_case(False))
+case('count-stream')(count_case(True))
+
+
+def bench(name, func, args, fixtures):
+    '''Run a case and print its timings.  Returns False if the case's checks failed.'''
+    try:
+        setup, run, count, unit = func(args, fixtures)
+    except (ImportError, SyntaxError) as e:
+        print('%-24s skipped (%s)' % (name, e))
+        return True
+    except CheckFailed as e:
+        print('%-24s FAILED: %s' % (name, e))
+        return False
+    times = []
+    for _ in range(args.repeat):
+        state = setup() if setup else None
+        start = timeit.default_timer()
+        run(state)
+        times.append(timeit.default_timer() - start)
+    best = min(times)
+    print('%-24s best %8.4fs  mean %8.4fs  %10.0f %s/s' % (
+        name, best, sum(times) / len(times), count / best if best else 0, unit))
+    return True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline benchmarks with synthetic fixtures')
+    parser.add_argument('cases', nargs='*', help='cases to run (default: all of %s)' %
+                        ', '.join(name for name, _ in CASES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=20, help='pages per ABBYY fixture')
+    parser.add_argument('--chars', type=int, default=2000, help='chars per ABBYY page')
+    parser.add_argument('--records', type=int, default=500, help='MARC records / IA items')
+    parser.add_argument('--requests', type=int, default=50, help='requests to the stub HTTP server')
+    parser.add_argument('--keep', help='generate fixtures in this directory and keep them')
+    args = parser.parse_args(argv[1:])
+
+    fixtures = args.keep or tempfile.mkdtemp(prefix='olbench')
+    if not os.path.exists(fixtures):
+        os.makedirs(fixtures)
+    failed = []
+    try:
+        for name, func in CASES:
+            if (not args.cases or name in args.cases) and not bench(name, func, args, fixtures):
+                failed.append(name)
+    finally:
+        for server in STUB_SERVERS:
+            server.shutdown()
+            server.server_close()
+        if not args.keep:
+            shutil.rmtree(fixtures)
+    if failed:
+        sys.exit('Failed checks: %s' % ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
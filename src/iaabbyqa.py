@@ -6,11 +6,20 @@ Prototype to tally ABBY OCR stats as recorded in XML file including:
 '''
 from __future__ import print_function
 
+from array import array
+import argparse
+import csv
 from datetime import datetime
 import glob
 import gzip
+import json
 import lxml.etree as ET
+import multiprocessing
+import os
+import re
+import sqlite3
 import sys
+import zlib
 
 DEBUG = False
 HEADER = [b'<?xml version="1.0" encoding="UTF-8"?>',
@@ -19,99 +28,416 @@ HEADER = [b'<?xml version="1.0" encoding="UTF-8"?>',
 ]
 
 CACHE_DIR = '../cache/'
+RESULTS_DB = CACHE_DIR + 'abbyyqa.sqlite'
+ENGINES = ('dom', 'stream', 'fast')
+CHUNK_SIZE = 1 << 20
 
+# Used by the fast engine, which tallies the raw bytes of each page in bulk instead of parsing XML
+PAGE_RE = re.compile(br'<page[\s>]')
+SPACE_END = b'> </charParams>' # spaces aren't tallied
+CONFIDENCE_RE = re.compile(br'charConfidence="(-?\d+)"')
+WORD_START_RE = re.compile(br'wordStart="true"([^>]*)') # ABBYY writes the word attributes after this
+PENALTY_RE = re.compile(br'wordPenalty="([^"]*)"')
 
-def processfile(filename):
-    print('Opening %s' % filename)
-    pagenum = 0
-    xmllinenum = 0
-    wordcount = 0
-    susp_count = 0
-    charcount = 0
-    dic_count = 0
-    penalty_tot = 0
-    penalty_count = 0
-    conf_tot = 0
+class OcrStats(object):
+    '''
+    Running tallies for a single ABBYY file.  Both parsing engines feed
+    characters through add_char() so they produce identical numbers.
+    '''
+    def __init__(self):
+        self.pagenum = 0
+        self.wordcount = 0
+        self.susp_count = 0
+        self.charcount = 0
+        self.dic_count = 0
+        self.penalty_tot = 0
+        self.penalty_count = 0
+        self.conf_tot = 0
+        # Per page breakdown, one entry per page
+        self.page_words = array('l')
+        self.page_dict_pct = array('d')
+        self.page_suspicious = array('l')
+        self.page_confidence = array('d')
+        # Totals as of the end of the previous page
+        self._last = (0, 0, 0, 0, 0)
+        # Word attributes of the current word, used for DEBUG consistency checks
+        self.wdic = self.wpenalty = self.wnormal = None
+
+    def end_page(self):
+        '''Close out the current page, appending its values to the per-page arrays'''
+        self.pagenum += 1
+        words, dic, susp, chars, conf = self._last
+        words = self.wordcount - words
+        chars = self.charcount - chars
+        self.page_words.append(words)
+        self.page_dict_pct.append((self.dic_count - dic) * 100.0 / words if words else 0.0)
+        self.page_suspicious.append(self.susp_count - susp)
+        self.page_confidence.append((self.conf_tot - conf) * 1.0 / chars if chars else 0.0)
+        self._last = (self.wordcount, self.dic_count, self.susp_count, self.charcount, self.conf_tot)
+
+    def add_char(self, c):
+        if c.text == ' ':
+            return
+        conf = int(c.get('charConfidence', 255))
+        self.conf_tot += conf
+        self.charcount += 1
+        susp = c.get('suspicious', False)
+        if susp:
+            self.susp_count += 1
+        start = c.get('wordStart', False)
+
+        # Word attributes - these should stay constant for whole word
+        dic = c.get('wordFromDictionary', False)
+        penalty = c.get('wordPenalty', False)
+        normal = c.get('wordNormal', False)
+        if start == 'true':
+            self.wordcount += 1
+            self.wdic = dic
+            self.wpenalty = penalty
+            self.wnormal = normal
+            if dic == 'true':
+                self.dic_count += 1
+            if penalty and penalty != '0':
+                self.penalty_tot += int(penalty)
+                self.penalty_count += 1
+        elif DEBUG:
+            if dic != self.wdic:
+                print('Warning dictionary flag not consistent for entire word')
+            if penalty != self.wpenalty:
+                print('Warning penalty not consistent for entire word')
+                print(ET.tostring(c))
+            if normal != self.wnormal:
+                print('Warning normal flag not consistent for entire word')
+
+    def record(self, filename, error=None):
+        '''Plain dict of the totals, suitable for pickling between processes'''
+        return {
+            'file': filename,
+            'pages': self.pagenum,
+            'words': self.wordcount,
+            'chars': self.charcount,
+            'suspicious': self.susp_count,
+            'dict_words': self.dic_count,
+            'penalty_words': self.penalty_count,
+            'penalty_total': self.penalty_tot,
+            'confidence_total': self.conf_tot,
+            'page_words': self.page_words,
+            'page_dict_pct': self.page_dict_pct,
+            'page_suspicious': self.page_suspicious,
+            'page_confidence': self.page_confidence,
+            'error': error,
+        }
+
+
+PAGE_COLUMNS = ('page_words', 'page_dict_pct', 'page_suspicious', 'page_confidence')
+OUTPUT_FORMATS = ('csv', 'jsonl', 'parquet')
+TOTALS = ('pages', 'words', 'chars', 'suspicious', 'dict_words',
+          'penalty_words', 'penalty_total', 'confidence_total')
+
+
+def aggregate(records):
+    '''Sum the totals of a number of per-file records into a corpus-wide record'''
+    corpus = dict((k, 0) for k in TOTALS)
+    corpus['file'] = None
+    corpus['error'] = None
+    corpus['files'] = 0
+    corpus['errors'] = 0
+    for r in records:
+        corpus['files'] += 1
+        if r['error']:
+            corpus['errors'] += 1
+        for k in TOTALS:
+            corpus[k] += r[k]
+    return corpus
+
+
+def summary(record):
+    avg_word_penalty = 0
+    avg_word_chars = 0
+    pct_in_dict = 0
+    penalty_pct = 0
+    wordcount = record['words']
+    charcount = record['chars']
+    if wordcount:
+        avg_word_penalty = record['penalty_total'] * 1.0 / wordcount
+        pct_in_dict = record['dict_words'] * 100.0 / wordcount
+        avg_word_chars = charcount * 1.0 / wordcount
+        penalty_pct = record['penalty_words'] * 100.0 / wordcount
+    avg_char_confidence = 0
+    if charcount:
+        avg_char_confidence = record['confidence_total'] * 1.0 / charcount
+    return ("%d pages, %d words, %5.2f%% in dict, %5.2f%% penalties, %5.2f char/word, %5.2f avg word penalty, %5.2f char conf" %
+            (record['pages'], wordcount, pct_in_dict, penalty_pct, avg_word_chars, avg_word_penalty, avg_char_confidence))
+
+
+def write_records(records, filename, fmt):
+    '''
+    Write per-page stats for a set of file records.
+
+    csv: one row per page
+    jsonl: one line per file with totals and per-page arrays
+    parquet: one row per page, columnar (requires pyarrow)
+    '''
+    if fmt == 'jsonl':
+        with open(filename, 'w') as output:
+            for r in records:
+                r = dict((k, list(v) if k in PAGE_COLUMNS else v) for k, v in r.items())
+                output.write(json.dumps(r, sort_keys=True) + '\n')
+        return
+
+    columns = [('file', []), ('page', array('l'))] + [(k, array(r_type)) for k, r_type in
+                                                      zip(PAGE_COLUMNS, 'ldld')]
+    cols = dict(columns)
+    for r in records:
+        n = len(r['page_words'])
+        cols['file'].extend([r['file']] * n)
+        cols['page'].extend(range(1, n + 1))
+        for k in PAGE_COLUMNS:
+            cols[k].extend(r[k])
+    names = [name for name, _ in columns]
+
+    if fmt == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_arrays([pyarrow.array(cols[k]) for k in names], names=names)
+        pyarrow.parquet.write_table(table, filename)
+    else:
+        with open(filename, 'w') as output:
+            writer = csv.writer(output)
+            writer.writerow(names)
+            for row in zip(*[cols[k] for k in names]):
+                writer.writerow(row)
+
+
+def scan_pages(f, stats):
+    '''
+    Original engine: accumulate the lines of each <page> element and build a
+    separate DOM for it.  Requires <page and </page tags to start a line.
+    '''
+    for line in f:
+        if line.startswith(b'<page'):
+            xml = list(HEADER)
+            while not line.startswith(b'</page'):
+                xml.append(line)
+                line = next(f)
+            xml.append(line)
+        #        xml.append('</document>')
+
+            dom = ET.fromstring(b'\n'.join(xml))
+            for c in dom.findall('.//charParams'):
+                stats.add_char(c)
+            stats.end_page()
+
+
+def scan_stream(f, stats):
+    '''
+    Streaming engine: pull charParams elements straight off the (gzip) stream
+    with iterparse and discard each page once it has been tallied, so memory
+    use stays flat regardless of file size or line layout.
+    '''
+    for _, elem in ET.iterparse(f, events=('end',), tag=('{*}page', '{*}charParams')):
+        if elem.tag.endswith('charParams'):
+            stats.add_char(elem)
+            elem.clear()
+        else:
+            stats.end_page()
+            elem.clear()
+            # Drop references to already processed pages held by <document>
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def tally_fast(data, stats):
+    '''
+    Add the characters in a slice of raw ABBYY XML to stats.  Everything is
+    counted with a few substring and regex passes over the whole slice
+    rather than character by character.
+    '''
+    if SPACE_END in data:
+        # Drop the spaces: every piece but the last ends with a space's start tag
+        pieces = data.split(SPACE_END)
+        data = b''.join([p[:p.rfind(b'<charParams')] for p in pieces[:-1]] + pieces[-1:])
+    chars = data.count(b'<charParams')
+    confidences = CONFIDENCE_RE.findall(data)
+    stats.charcount += chars
+    stats.conf_tot += sum(map(int, confidences)) + 255 * (chars - len(confidences))
+    stats.susp_count += data.count(b'suspicious="') - data.count(b'suspicious=""')
+    # Word attributes are taken from the first char of each word
+    starts = WORD_START_RE.findall(data)
+    stats.wordcount += len(starts)
+    starts = b'\n'.join(starts)
+    stats.dic_count += starts.count(b'wordFromDictionary="true"')
+    penalties = [int(p) for p in PENALTY_RE.findall(starts) if p and p != b'0']
+    stats.penalty_tot += sum(penalties)
+    stats.penalty_count += len(penalties)
+
+
+def scan_fast(f, stats):
+    '''
+    Fast engine: split the decompressed bytes at <page> start tags and tally
+    each page in bulk with tally_fast(), without building any elements.
+    Relies on ABBYY's regular attribute formatting and skips the DEBUG
+    consistency checks.
+    '''
+    buf = b''
+    in_page = False # whether buf starts with a <page> start tag
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        # Only search the new bytes, plus enough of the old for a tag split between chunks
+        search_from = max(len(buf) - len(b'<page'), 1 if in_page else 0)
+        buf += chunk
+        cuts = [m.start() for m in PAGE_RE.finditer(buf, search_from)]
+        if not chunk:
+            cuts.append(len(buf))
+        pos = 0
+        for cut in cuts:
+            tally_fast(buf[pos:cut], stats)
+            if in_page:
+                stats.end_page()
+            in_page = True
+            pos = cut
+        buf = buf[pos:]
+        if not chunk:
+            break
+
+
+def processfile(filename, engine='dom'):
+    '''
+    Tally a single ABBYY file and return its stats record.  Nothing is
+    printed so this can run in a worker process.
+    '''
+    stats = OcrStats()
+    error = None
     with gzip.open(filename, 'rb') as f:
         try:
-            for line in f:
-                xmllinenum += 1
-                if line.startswith(b'<page'):
-                    pagenum += 1
-                    xml = list(HEADER)
-                    while not line.startswith(b'</page'):
-                        xml.append(line)
-                        xmllinenum += 1
-                        line = next(f)
-                    xml.append(line)
-                #        xml.append('</document>')
-
-                    dom = ET.fromstring(b'\n'.join(xml))
-                    chars = dom.findall('.//charParams')
-                    for c in chars:
-                        if c.text == ' ':
-                            continue
-                        conf = int(c.get('charConfidence', 255))
-                        conf_tot = conf_tot + conf
-                        charcount += 1
-                        susp = c.get('suspicious', False)
-                        if susp:
-                            susp_count += 1
-                        start = c.get('wordStart', False)
-
-                        # Word attributes - these should stay constant for whole word
-                        dic = c.get('wordFromDictionary', False)
-                        penalty = c.get('wordPenalty', False)
-                        normal = c.get('wordNormal', False)
-                        if start == 'true':
-                            wordcount += 1
-                            wdic = dic
-                            wpenalty = penalty
-                            wnormal = normal
-                            if dic == 'true':
-                                dic_count += 1
-                            if penalty and penalty != '0':
-                                penalty_tot += int(penalty)
-                                penalty_count += 1
-                        elif DEBUG:
-                            if dic != wdic:
-                                print('Warning dictionary flag not consistent for entire word')
-                            if penalty != wpenalty:
-                                print('Warning penalty not consistent for entire word')
-                                print(ET.tostring(c))
-                            if normal != wnormal:
-                                print('Warning normal flag not consistent for entire word')
-
-            avg_word_penalty = 0
-            avg_word_chars = 0
-            pct_in_dict = 0
-            penalty_pct = 0
-            if wordcount:
-                avg_word_penalty = penalty_tot * 1.0 / wordcount
-                pct_in_dict = dic_count * 100.0 / wordcount
-                avg_word_chars = charcount * 1.0 / wordcount
-                penalty_pct = penalty_count * 100.0 / wordcount
-            avg_char_confidence = 0
-            if charcount:
-                avg_char_confidence = conf_tot * 1.0 / charcount
-            print("%d pages, %d words, %5.2f%% in dict, %5.2f%% penalties, %5.2f char/word, %5.2f avg word penalty, %5.2f char conf" %
-                  (pagenum, wordcount, pct_in_dict, penalty_pct, avg_word_chars, avg_word_penalty, avg_char_confidence))
-
-        except IOError as e:
-            print('Error decoding ', filename, e)
+            if engine == 'stream':
+                scan_stream(f, stats)
+            elif engine == 'fast':
+                scan_fast(f, stats)
+            else:
+                scan_pages(f, stats)
+        except (IOError, EOFError, zlib.error, ET.XMLSyntaxError) as e:
+            # A truncated .gz (e.g. an interrupted download) raises EOFError
+            error = str(e) or type(e).__name__
+    return stats.record(filename, error)
+
+
+def open_results(filename):
+    '''Open (creating if needed) the SQLite store of previously computed records'''
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    db = sqlite3.connect(filename)
+    db.execute('CREATE TABLE IF NOT EXISTS results ('
+               'file TEXT, engine TEXT, size INTEGER, mtime REAL, record TEXT, '
+               'PRIMARY KEY (file, engine))')
+    return db
+
+
+def load_result(db, filename, engine='dom'):
+    '''
+    Return the record stored for filename by `engine` if the file's size and
+    mtime are unchanged since it was computed, otherwise None.
+    '''
+    st = os.stat(filename)
+    row = db.execute('SELECT record FROM results WHERE file = ? AND engine = ? AND size = ? AND mtime = ?',
+                     (os.path.abspath(filename), engine, st.st_size, st.st_mtime)).fetchone()
+    if row:
+        record = json.loads(row[0])
+        record['file'] = filename
+        for k, r_type in zip(PAGE_COLUMNS, 'ldld'):
+            record[k] = array(r_type, record[k])
+        return record
+
+
+def save_result(db, record, engine='dom'):
+    st = os.stat(record['file'])
+    stored = dict((k, list(v) if k in PAGE_COLUMNS else v) for k, v in record.items())
+    db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+               (os.path.abspath(record['file']), engine, st.st_size, st.st_mtime, json.dumps(stored)))
+    db.commit()
+
+
+def processfiles(files, engine='dom', jobs=1, db=None, force=False):
+    '''
+    Generate stats records for files, in the order given.  With jobs > 1 the
+    files are spread across a process pool, largest first, so that a single
+    huge scan doesn't end up as the tail of the run.
+
+    If a results store is given, files which haven't changed since they were
+    last processed by the same engine are served from it (unless force is set) and newly
+    computed records are added to it.  Records with errors aren't stored.
+    '''
+    cached = {}
+    if db is not None and not force:
+        for f in files:
+            record = load_result(db, f, engine)
+            if record:
+                cached[f] = record
+    todo = [f for f in files if f not in cached]
+
+    pool = None
+    results = {}
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(jobs)
+        for f in sorted(todo, key=os.path.getsize, reverse=True):
+            results[f] = pool.apply_async(processfile, (f, engine))
+        pool.close()
+    try:
+        for f in files:
+            if f in cached:
+                yield cached[f]
+                continue
+            record = results[f].get() if pool else processfile(f, engine)
+            if db is not None and not record['error']:
+                save_result(db, record, engine)
+            yield record
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
 
 
 def main(argv):
-    if argv:
-        files = [argv[1]]
-    else:
+    parser = argparse.ArgumentParser(description='Tally ABBYY OCR quality stats')
+    parser.add_argument('files', nargs='*',
+                        help='ABBYY .gz files (default: all *_abbyy.gz in %s)' % CACHE_DIR)
+    parser.add_argument('--engine', choices=ENGINES, default='dom',
+                        help='dom: per-page DOM (original), stream: iterparse over whole file, '
+                        'fast: bulk substring and regex tallies per page, several times faster')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('--output', '-o',
+                        help='write per-page stats to this file')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv',
+                        help='format for --output (default: csv)')
+    parser.add_argument('--results', default=RESULTS_DB,
+                        help='SQLite store of previous results (default: %s)' % RESULTS_DB)
+    parser.add_argument('--no-results', action='store_true',
+                        help="don't read or update the results store")
+    parser.add_argument('--force', action='store_true',
+                        help='reprocess all files, rebuilding their stored results')
+    args = parser.parse_args(argv[1:])
+
+    files = args.files
+    if not files:
         files = glob.glob(CACHE_DIR+'*_abbyy.gz')
         print('Found %d files' % len(files))
     start = datetime.now()
-    for f in files:
-        processfile(f)
+    db = None if args.no_results else open_results(args.results)
+    records = []
+    for record in processfiles(files, args.engine, args.jobs, db, args.force):
+        records.append(record)
+        if record['error']:
+            print('Error decoding ', record['file'], record['error'])
+        else:
+            print('%s: %s' % (record['file'], summary(record)))
+    corpus = aggregate(records)
+    print('Corpus: %d files (%d errors), %s' % (corpus['files'], corpus['errors'], summary(corpus)))
+    if args.output:
+        write_records(records, args.output, args.format)
     print('Processed %d files in %s' % (len(files), str(datetime.now() - start)))
 
-    
+
 if __name__ == '__main__':
     main(sys.argv)
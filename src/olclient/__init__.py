@@ -0,0 +1,17 @@
+'''
+Shared HTTP client support for the OpenLibrary utilities: one cached,
+rate limited and retrying session, plus the OpenLibrary and Internet
+Archive lookups built on it.
+'''
+from .archive import find_file, get_file, get_files, item_file
+from .cachepolicy import CachePolicy, PolicySession
+from .fetcher import QUEUE_SIZE, WORKERS, fetch_all, mount_rate_limiter, ordered_map
+from .filestore import FileStore, get_store
+from .marc import find_field, get_marc_xml, marc_year_language, probe_008, probe_field
+from .marctransform import RecordTransform, load_transform
+from .marcwriter import FORMATS, RecordWriter, encode_record, open_writers
+from .openlibrary import OL_BASE, get_ia_edition, get_ia_editions, get_json, get_many
+from .pipeline import Stage, run_pipeline
+from .ratelimit import HostRateLimiter, RateLimitedAdapter, TokenBucket
+from .session import CACHE_DIR, SessionStats, get_session, make_session
+from .shorturls import BitlyShortener, ShortURLStore, StubShortener, shorten_all
@@ -0,0 +1,83 @@
+'''
+Fetching files from Internet Archive items.
+'''
+from __future__ import print_function
+
+from requests import ConnectionError
+
+from .filestore import FILES_XML, get_store, parse_files_xml
+from .session import CACHE_DIR, get_session
+
+IA_DOWNLOAD = 'http://archive.org/download/%s/%s%s'
+
+
+def get_file(iaid, suffix, body=False, session=None):
+    '''
+    Test whether a file in the given format is available for an Internet Archive ID.
+    Follows redirects if necessary.
+
+    If the "suffix" parameter doesn't contain a period, one will be prepended.
+    This allows both "epub" and "_files.xml" style suffixes.
+
+    if body=False (default), the content will not be fetched.  Redirects are followed and the
+    final URL is returned.  If this is True, the actual content will be fetched and returned.
+    '''
+    session = session or get_session()
+    if suffix.find('.') < 0:
+        suffix = '.'+suffix
+    url = IA_DOWNLOAD % (iaid, iaid, suffix)
+
+    try:
+        if not body:
+            epub = session.head(url)
+        else:
+            epub = session.get(url)
+
+        if epub.status_code == 302:
+            url = epub.headers['location']
+            if not body:
+                epub = session.head(url)
+            else:
+                epub = session.get(url)
+        if epub.status_code == 200:
+            return epub if body else url
+        elif epub.status_code != 403:
+            print('HTTP error (%d) fetching %s for %s from %s ' % (epub.status_code, suffix, iaid, url))
+    except ConnectionError as e:
+        print('Error fetching URL: ', url, e)
+    return None
+
+
+def get_files(ia, cache_dir=CACHE_DIR, session=None):
+    '''
+    Return the list of file names in an IA item.  Listings are kept in the
+    FileStore for cache_dir so each item's _files.xml is only fetched and
+    parsed once.
+    '''
+    store = get_store(cache_dir)
+    files = store.get(ia)
+    if files is None:
+        files_xml = get_file(ia, FILES_XML, body=True, session=session)
+        if files_xml and files_xml.status_code == 200:
+            files = parse_files_xml(files_xml.content)
+            store.put(ia, files)
+    if files is not None:
+        return [name for name, _ in files]
+
+
+def item_file(ia, suffix, cache_dir=CACHE_DIR, session=None):
+    '''
+    Return the name of the file with the given suffix (e.g. '_abbyy.gz') in
+    an IA item, or None.  An indexed lookup once the item's listing is stored.
+    '''
+    store = get_store(cache_dir)
+    if ia not in store:
+        get_files(ia, cache_dir, session)
+    return store.find(ia, suffix)
+
+
+def find_file(files, suffix):
+    if files and suffix:
+        for f in files:
+            if f[-len(suffix):len(f)] == suffix:
+                return f
@@ -0,0 +1,192 @@
+'''
+Expiry and size policy for the shared requests_cache cache.
+
+requests_cache on its own keeps every response forever, so the cache grows
+without bound and lists like recentchanges are never refreshed.  The policy
+keeps a small side table of when each URL was fetched and last used, and:
+
+- expires entries according to per-URL-pattern TTLs (archive.org download
+  files never change, searches and recentchanges go stale quickly), or
+  bypasses the cache for URLs which shouldn't be cached at all
+- evicts least recently used entries when the cache exceeds a size cap
+- can purge expired entries and vacuum the backend (compact)
+- counts hits, misses, expirations and evictions
+
+Run as a script to compact the shared cache:
+
+    python -m olclient.cachepolicy
+'''
+from __future__ import print_function
+
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+import requests_cache
+
+FOREVER = None
+NEVER = 0 # bypass the cache entirely
+HOUR = 3600
+DAY = 24 * HOUR
+# (URL pattern, TTL in seconds) - first match wins
+POLICIES = [
+    (r'^https?://([^/]+\.)?archive\.org/download/', FOREVER),
+    (r'^https?://api\.bit\.ly/', NEVER), # failures are reported with a 200; see shorturls.ShortURLStore
+    (r'^https?://openlibrary\.org/recentchanges/\d+\.json', FOREVER), # a single changeset
+    (r'^https?://openlibrary\.org/recentchanges/', HOUR),
+    (r'^https?://openlibrary\.org/search\.json', DAY),
+    (r'^https?://openlibrary\.org/', 7 * DAY),
+]
+DEFAULT_TTL = 30 * DAY
+MAX_BYTES = 2 * 1024 ** 3
+EVICT_TO = 0.9 # fraction of MAX_BYTES to evict down to
+CHECK_EVERY = 100 # misses between size checks
+
+
+class CachePolicy(object):
+    def __init__(self, cache, filename, policies=POLICIES, default_ttl=DEFAULT_TTL,
+                 max_bytes=MAX_BYTES):
+        self.cache = cache
+        self.policies = [(re.compile(pattern), ttl) for pattern, ttl in policies]
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.counts = dict.fromkeys(('hits', 'misses', 'expired', 'evicted'), 0)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous = OFF')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'url TEXT PRIMARY KEY, fetched REAL, accessed REAL, size INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def ttl(self, url):
+        for pattern, ttl in self.policies:
+            if pattern.match(url):
+                return ttl
+        return self.default_ttl
+
+    def delete(self, urls):
+        '''Remove URLs from the cache backend and the policy table'''
+        for url in urls:
+            if hasattr(self.cache, 'delete_url'):
+                self.cache.delete_url(url)
+            else:
+                self.cache.delete(urls=[url], vacuum=False)
+        with self.lock:
+            with self.db:
+                self.db.executemany('DELETE FROM entries WHERE url = ?', [(url,) for url in urls])
+
+    def expire(self, url):
+        '''Drop the cached response for url if it is older than its TTL'''
+        ttl = self.ttl(url)
+        if ttl is FOREVER:
+            return
+        with self.lock:
+            row = self.db.execute('SELECT fetched FROM entries WHERE url = ?', (url,)).fetchone()
+        if row and time.time() - row[0] > ttl:
+            self.delete([url])
+            with self.lock:
+                self.counts['expired'] += 1
+
+    def record(self, url, response, stored=True):
+        '''
+        Note a response for url, whether served from the cache or fetched.
+        Fetched responses which weren't `stored` in the cache (e.g. errors
+        and partial content) aren't counted.
+        '''
+        now = time.time()
+        check = False
+        with self.lock:
+            if getattr(response, 'from_cache', False):
+                self.counts['hits'] += 1
+                self.db.execute('UPDATE entries SET accessed = ? WHERE url = ?', (now, url))
+            elif stored:
+                self.counts['misses'] += 1
+                size = int(response.headers.get('content-length') or 0)
+                if not size and getattr(response, '_content', False):
+                    size = len(response._content)
+                self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (url, now, now, size))
+                check = self.counts['misses'] % CHECK_EVERY == 0
+            self.db.commit()
+        if check:
+            self.evict()
+
+    def size(self):
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        '''If the cache is over its size cap, drop least recently used entries'''
+        size = self.size()
+        if size <= self.max_bytes:
+            return
+        excess = size - self.max_bytes * EVICT_TO
+        victims = []
+        with self.lock:
+            for url, size in self.db.execute('SELECT url, size FROM entries ORDER BY accessed'):
+                victims.append(url)
+                excess -= size
+                if excess <= 0:
+                    break
+        self.delete(victims)
+        with self.lock:
+            self.counts['evicted'] += len(victims)
+
+    def compact(self):
+        '''Purge all expired entries, enforce the size cap and vacuum the backend'''
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute('SELECT url, fetched FROM entries').fetchall()
+        expired = [url for url, fetched in rows
+                   if self.ttl(url) is not FOREVER and now - fetched > self.ttl(url)]
+        self.delete(expired)
+        with self.lock:
+            self.counts['expired'] += len(expired)
+        self.evict()
+        filename = getattr(self.cache.responses, 'db_path', None) or getattr(self.cache.responses, 'filename', None)
+        if filename:
+            db = sqlite3.connect(str(filename))
+            db.execute('VACUUM')
+            db.close()
+        with self.lock:
+            self.db.execute('VACUUM')
+
+    def report(self):
+        return 'cache: %(hits)d hits, %(misses)d misses, %(expired)d expired, %(evicted)d evicted' % self.counts \
+            + ', %.1f MB' % (self.size() / 1024.0 ** 2)
+
+
+class PolicySession(requests_cache.CachedSession):
+    '''CachedSession which applies `self.policy` (a CachePolicy) to every request'''
+    policy = None
+
+    def send(self, request, **kwargs):
+        if self.policy is None or request.method not in ('GET', 'HEAD'):
+            return super(PolicySession, self).send(request, **kwargs)
+        if self.policy.ttl(request.url) == NEVER:
+            # Per request rather than cache_disabled(), which would affect other threads
+            response = requests.Session.send(self, request, **kwargs)
+            response.from_cache = False
+            return response
+        self.policy.expire(request.url)
+        response = super(PolicySession, self).send(request, **kwargs)
+        stored = getattr(response, 'from_cache', False) or self.is_cached(request)
+        self.policy.record(request.url, response, stored)
+        return response
+
+    def is_cached(self, request):
+        '''Whether the backend has a response for request; only allowable status codes are saved'''
+        if hasattr(self.cache, 'contains'):
+            return self.cache.contains(request=request)
+        return self.cache.has_key(self.cache.create_key(request))
+
+
+if __name__ == '__main__':
+    from .session import get_session
+    session = get_session()
+    before = session.policy.size()
+    session.policy.compact()
+    print('Compacted cache from %.1f MB to %.1f MB' % (before / 1024.0 ** 2, session.policy.size() / 1024.0 ** 2))
+    print(session.policy.report())
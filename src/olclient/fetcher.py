@@ -0,0 +1,60 @@
+'''
+Run blocking fetches concurrently on a thread pool.
+'''
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from .ratelimit import HostRateLimiter, RateLimitedAdapter
+
+WORKERS = 4 # maximum requests in flight
+QUEUE_SIZE = 32 # maximum results waiting to be consumed
+
+
+def mount_rate_limiter(session, rates=None, default=2.0, workers=WORKERS, max_retries=0):
+    '''
+    Rate limit the uncached requests of `session` per host and size its
+    connection pools for `workers` concurrent requests.  Returns the limiter.
+    '''
+    limiter = HostRateLimiter(rates, default)
+    adapter = RateLimitedAdapter(limiter, pool_connections=len(limiter.rates) + 1,
+                                 pool_maxsize=workers, max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return limiter
+
+
+def fetch_all(func, items, workers=WORKERS):
+    '''
+    Call func on each item with up to `workers` calls in flight and return
+    the results as a list in the same order as `items`.
+    '''
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(i) for i in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def ordered_map(func, items, workers=WORKERS, queue_size=QUEUE_SIZE):
+    '''
+    Generate func(item) for each of `items` in order, with up to `workers`
+    calls running concurrently.  Unlike ThreadPool.imap, items are only
+    read as results are consumed, so no more than `queue_size` are in
+    flight or waiting at once and memory stays flat however long `items` is.
+    '''
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= queue_size:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
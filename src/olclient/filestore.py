@@ -0,0 +1,152 @@
+'''
+Indexed local store of Internet Archive item file listings.
+
+Replaces the per-item _files.xml cache files with a single SQLite database
+mapping IA identifier -> file names and formats.  Each file is also indexed
+by its suffix (the name with the identifier prefix removed, e.g. _abbyy.gz)
+so checks like "does this item have a _meta.mrc" are a single index lookup
+with no XML parsing.  Files whose names don't start with the identifier are
+still found, by a scan of the item's (indexed) file list.
+
+MARC fields probed from an item's records with Range requests are kept
+here too, since requests_cache only stores complete (200) responses.
+
+Run as a script to bulk import existing _files.xml caches:
+
+    python -m olclient.filestore [cache_dir]
+'''
+from __future__ import print_function
+
+import glob
+import os
+import sqlite3
+import sys
+import threading
+import xml.etree.ElementTree as ET
+
+STORE_NAME = 'files.sqlite'
+FILES_XML = '_files.xml'
+
+
+def parse_files_xml(content):
+    '''Return the [(name, format)] list from the contents of an IA _files.xml'''
+    root = ET.fromstring(content)
+    return [(f.get('name'), f.findtext('format')) for f in root.findall('file')]
+
+
+def file_suffix(ia, name):
+    return name[len(ia):] if name.startswith(ia) else name
+
+
+class FileStore(object):
+    '''
+    SQLite backed IA file listing store.  Safe to share between threads.
+    '''
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS items (ia TEXT PRIMARY KEY)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                            'ia TEXT, name TEXT, format TEXT, suffix TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_ia_suffix ON files (ia, suffix)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS fields ('
+                            'ia TEXT, tag TEXT, data BLOB, PRIMARY KEY (ia, tag))')
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def __contains__(self, ia):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM items WHERE ia = ?', (ia,)).fetchone() is not None
+
+    def get(self, ia):
+        '''Return the [(name, format)] listing for an item or None if it isn't known'''
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM items WHERE ia = ?', (ia,)).fetchone() is None:
+                return None
+            return self.db.execute('SELECT name, format FROM files WHERE ia = ? ORDER BY rowid',
+                                   (ia,)).fetchall()
+
+    def find(self, ia, suffix):
+        '''
+        Return the name of the item's file ending with the given suffix, if
+        any, preferring <ia><suffix> like IA's derived files.
+        '''
+        if not suffix:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT name FROM files WHERE ia = ? AND suffix = ? LIMIT 1',
+                                  (ia, suffix)).fetchone()
+            if row is None:
+                row = self.db.execute('SELECT name FROM files WHERE ia = ? AND substr(name, -?) = ? '
+                                      'ORDER BY rowid LIMIT 1', (ia, len(suffix), suffix)).fetchone()
+        return row[0] if row else None
+
+    def put(self, ia, files):
+        self.put_many([(ia, files)])
+
+    def put_many(self, listings):
+        '''Store (ia, [(name, format)]) listings in a single transaction'''
+        with self.lock:
+            with self.db:
+                for ia, files in listings:
+                    self.db.execute('DELETE FROM files WHERE ia = ?', (ia,))
+                    self.db.execute('INSERT OR REPLACE INTO items VALUES (?)', (ia,))
+                    self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?)',
+                                        [(ia, name, fmt, file_suffix(ia, name)) for name, fmt in files])
+
+    def get_field(self, ia, tag):
+        '''Return the raw data of a MARC field stored by put_field, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT data FROM fields WHERE ia = ? AND tag = ?', (ia, tag)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put_field(self, ia, tag, data):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO fields VALUES (?, ?, ?)',
+                                (ia, tag, sqlite3.Binary(data)))
+
+    def import_files_xml(self, cache_dir):
+        '''Bulk import all the <ia>_files.xml files in cache_dir.  Returns the number imported'''
+        listings = []
+        for filename in glob.glob(os.path.join(cache_dir, '*' + FILES_XML)):
+            ia = os.path.basename(filename)[:-len(FILES_XML)]
+            try:
+                with open(filename, 'rb') as f:
+                    listings.append((ia, parse_files_xml(f.read())))
+            except ET.ParseError as e:
+                print('Skipping unparseable %s: %s' % (filename, e))
+        self.put_many(listings)
+        return len(listings)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(cache_dir):
+    '''
+    Return the shared FileStore for a cache directory.  The first time the
+    store is created any existing _files.xml files there are imported.
+    '''
+    with _stores_lock:
+        if cache_dir not in _stores:
+            filename = os.path.join(cache_dir, STORE_NAME)
+            new = not os.path.exists(filename)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            store = FileStore(filename)
+            if new:
+                store.import_files_xml(cache_dir)
+            _stores[cache_dir] = store
+        return _stores[cache_dir]
+
+
+if __name__ == '__main__':
+    from .session import CACHE_DIR
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else CACHE_DIR
+    store = FileStore(os.path.join(cache_dir, STORE_NAME))
+    print('Imported %d _files.xml listings' % store.import_files_xml(cache_dir))
@@ -0,0 +1,180 @@
+'''
+Lightweight binary MARC21 access.
+
+Reads individual control fields using just the leader and directory, so
+that for fields near the start of a record (like 008) only the first few
+hundred bytes of a _meta.mrc file need to be fetched, using HTTP Range
+requests.
+
+Also fetches whole MARC XML records, keeping the raw XML locally by IA id.
+'''
+from __future__ import print_function
+
+import io
+import os
+import time
+from xml.sax import SAXParseException
+
+from requests import RequestException
+
+from .archive import IA_DOWNLOAD
+from .filestore import get_store
+from .session import CACHE_DIR, get_session
+
+LEADER_LEN = 24
+FIELD_TERMINATOR = b'\x1e'
+PROBE_BYTES = 1024 # first fetch; enough for the directory and 008 of most records
+MARC_XML = '_archive_marc.xml' # IA's MARC record for the electronic version
+MARC_XML_DIR = 'marcxml' # subdirectory of the cache for raw MARC XML
+XML_RETRIES = 4
+XML_BACKOFF = 1.0 # seconds, doubled for each retry
+
+
+class IncompleteRecord(Exception):
+    '''Raised when the data ends before the requested field; `needed` bytes are required'''
+    def __init__(self, needed):
+        Exception.__init__(self, 'need %d bytes of MARC record' % needed)
+        self.needed = needed
+
+
+def find_field(data, tag):
+    '''
+    Return the raw data for the first `tag` field in the binary MARC record
+    at the start of `data`, or None if the record has no such field.  `data`
+    may be a prefix of the record; IncompleteRecord is raised if it's too
+    short, and ValueError if the leader or directory are malformed.
+    '''
+    if len(data) < LEADER_LEN:
+        raise IncompleteRecord(LEADER_LEN)
+    base = int(data[12:17])
+    if len(data) < base:
+        raise IncompleteRecord(base)
+    directory = data[LEADER_LEN:base - 1]
+    tag = tag.encode('ascii')
+    for i in range(0, len(directory) - 11, 12):
+        if directory[i:i + 3] == tag:
+            length = int(directory[i + 3:i + 7])
+            start = base + int(directory[i + 7:i + 12])
+            if len(data) < start + length:
+                raise IncompleteRecord(start + length)
+            return data[start:start + length].rstrip(FIELD_TERMINATOR)
+    return None
+
+
+def year_language(field):
+    '''Return the (year, language) pair from the value of an 008 field'''
+    field = field.decode('latin-1')
+    return field[7:11], field[35:38]
+
+
+def marc_year_language(content):
+    '''Return the (year, language) pair from the 008 field of a binary MARC record'''
+    field = find_field(content, '008')
+    if field is None:
+        raise ValueError('MARC record has no 008 field')
+    return year_language(field)
+
+
+def probe_field(url, tag, session=None, probe_bytes=PROBE_BYTES):
+    '''
+    Fetch a field from the binary MARC record at `url` using Range requests
+    for just the leading bytes, extending the range if the directory or
+    field turn out to lie further in.  If the server ignores Range and sends
+    the whole file, that is used instead.
+
+    Returns the field data, None if the record has no such field or it
+    couldn't be fetched.
+    '''
+    session = session or get_session()
+    end = probe_bytes
+    while True:
+        response = session.get(url, headers={'Range': 'bytes=0-%d' % (end - 1)})
+        if response.status_code not in (200, 206):
+            if response.status_code != 403:
+                print('HTTP error (%d) fetching %s' % (response.status_code, url))
+            return None
+        try:
+            return find_field(response.content, tag)
+        except IncompleteRecord as e:
+            if response.status_code == 200 or len(response.content) < end:
+                # We already have the whole file
+                raise ValueError('Truncated MARC record at %s' % url)
+            end = e.needed
+
+
+def probe_008(iaid, session=None, cache_dir=CACHE_DIR):
+    '''
+    Return the (year, language) from the 008 field of an IA item's _meta.mrc
+    record, or None if it isn't available.  Probed fields are kept in the
+    cache directory's FileStore, as the partial responses aren't cached.
+    '''
+    store = get_store(cache_dir)
+    field = store.get_field(iaid, '008')
+    if field is None:
+        field = probe_field(IA_DOWNLOAD % (iaid, iaid, '_meta.mrc'), '008', session)
+        if field is None:
+            return None
+        store.put_field(iaid, '008', field)
+    return year_language(field)
+
+
+def parse_marc_xml(content):
+    '''Return the pymarc records from MARC XML content, raising SAXParseException if it's malformed'''
+    import pymarc
+    return pymarc.parse_xml_to_array(io.BytesIO(content))
+
+
+def get_marc_xml(iaid, suffix=MARC_XML, session=None, cache_dir=CACHE_DIR,
+                 retries=XML_RETRIES, backoff=XML_BACKOFF):
+    '''
+    Return the records of an IA item's MARC XML file, or None if it isn't
+    available.
+
+    The raw XML is kept in the cache directory by IA id, so later runs
+    don't depend on the HTTP cache (which may evict it).  Fetches go through
+    the shared session, and network errors, server errors and XML which
+    won't parse (usually a truncated download) are retried with exponential
+    backoff.
+    '''
+    session = session or get_session()
+    directory = os.path.join(cache_dir, MARC_XML_DIR)
+    filename = os.path.join(directory, iaid + suffix)
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            try:
+                return parse_marc_xml(f.read())
+            except SAXParseException:
+                pass # refetch it
+    url = IA_DOWNLOAD % (iaid, iaid, suffix)
+    error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = session.get(url)
+        except RequestException as e:
+            error = e
+            continue
+        if response.status_code in (403, 404):
+            print('HTTP error (%d) fetching %s' % (response.status_code, url))
+            return None
+        if response.status_code != 200:
+            error = 'HTTP error %d' % response.status_code
+            continue
+        try:
+            records = parse_marc_xml(response.content)
+        except SAXParseException as e:
+            error = e
+            # Don't get the same bad response from the cache next time
+            if getattr(session, 'policy', None):
+                session.policy.delete(set([url, response.url]))
+            continue
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(response.content)
+        os.rename(tmp, filename)
+        return records
+    print('Failed to fetch %s after %d attempts: %s' % (url, retries + 1, error))
+    return None
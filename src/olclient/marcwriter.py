@@ -0,0 +1,93 @@
+'''
+Incremental MARC record output in several formats.
+
+Each record is fully encoded before any of it is written, so a record which
+can't be encoded is rejected whole and never leaves a partial record in the
+output.  Records go to a buffered binary file which is flushed every few
+records, so output keeps pace with processing however long the list is.
+
+Formats:
+    marc   binary MARC21 (ISO 2709)
+    xml    MARCXML collection
+    jsonl  MARC-in-JSON, one record per line
+'''
+from __future__ import print_function
+
+import io
+import timeit
+
+FORMATS = ('marc', 'xml', 'jsonl')
+EXTENSIONS = {'marc': '.mrc', 'xml': '.xml', 'jsonl': '.jsonl'}
+BUFFER_SIZE = 1024 * 1024
+FLUSH_EVERY = 100 # records
+XML_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>\n<collection xmlns="http://www.loc.gov/MARC21/slim">\n'
+XML_FOOTER = b'</collection>\n'
+
+
+def encode_record(record, fmt):
+    '''Return the bytes for a pymarc record in one of FORMATS'''
+    if fmt == 'marc':
+        return record.as_marc()
+    if fmt == 'xml':
+        import pymarc
+        return pymarc.record_to_xml(record) + b'\n'
+    if fmt == 'jsonl':
+        data = record.as_json()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data + b'\n'
+    raise ValueError('Unknown MARC output format %s' % fmt)
+
+
+class RecordWriter(object):
+    '''Write pymarc records to a file in one format, keeping throughput counters'''
+    def __init__(self, filename, fmt='marc', buffer_size=BUFFER_SIZE, flush_every=FLUSH_EVERY):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown MARC output format %s' % fmt)
+        self.filename = filename
+        self.fmt = fmt
+        self.flush_every = flush_every
+        self.records = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.file = io.open(filename, 'wb', buffering=buffer_size)
+        if fmt == 'xml':
+            self._write(XML_HEADER)
+
+    def _write(self, data):
+        self.file.write(data)
+        self.bytes += len(data)
+
+    def encode(self, record):
+        start = timeit.default_timer()
+        data = encode_record(record, self.fmt)
+        self.seconds += timeit.default_timer() - start
+        return data
+
+    def write_data(self, data):
+        '''Write a record already encoded by encode()'''
+        start = timeit.default_timer()
+        self._write(data)
+        self.records += 1
+        if self.records % self.flush_every == 0:
+            self.file.flush()
+        self.seconds += timeit.default_timer() - start
+
+    def write(self, record):
+        '''Encode and write a record.  Encoding errors are raised before anything is written.'''
+        self.write_data(self.encode(record))
+
+    def close(self):
+        if self.fmt == 'xml':
+            self._write(XML_FOOTER)
+        self.file.close()
+
+    def report(self):
+        rate = self.records / self.seconds if self.seconds else 0
+        return '%-5s %6d records %10d bytes %10.0f records/s  %s' % (
+            self.fmt, self.records, self.bytes, rate, self.filename)
+
+
+def open_writers(basename, formats=FORMATS[:1], **kwargs):
+    '''Return a RecordWriter for each format, writing basename + the format's extension'''
+    return [RecordWriter(basename + EXTENSIONS[fmt], fmt, **kwargs) for fmt in formats]
@@ -0,0 +1,84 @@
+'''
+Fetching OpenLibrary records.
+'''
+from __future__ import print_function
+
+import json
+
+from .fetcher import fetch_all
+from .session import get_session
+
+OL_BASE = 'http://openlibrary.org'
+
+
+def get_json(url, session=None):
+    response = (session or get_session()).get(url)
+    if response.status_code == 200:
+        edition = response.json()
+        return edition
+    else:
+        print('Failed to get JSON for %s - status code %d' % (url, response.status_code))
+
+
+def get_ia_edition(iaid, session=None):
+    '''Get JSON for an edition using its IA identifier.  Follows non-HTTP OpenLibrary redirect records '''
+    edition_url = OL_BASE + '/books/ia:%s.json' % iaid
+    edition = get_json(edition_url, session)
+    if is_redirect(edition):
+        edition_url = OL_BASE + '%s.json' % edition['location']
+        edition = get_json(edition_url, session)
+    return edition
+
+
+BATCH_SIZE = 50 # keys per bulk request, keeping URLs to a reasonable length
+_editions = {} # memoized IA identifier -> edition record
+
+
+def is_redirect(doc):
+    return doc and 'type' in doc and 'key' in doc['type'] and doc['type']['key'] == '/type/redirect'
+
+
+def get_many(keys, session=None):
+    '''Fetch a number of OpenLibrary records by key in bulk.  Returns a dict of key -> record'''
+    result = {}
+    keys = list(keys)
+    for i in range(0, len(keys), BATCH_SIZE):
+        batch = keys[i:i + BATCH_SIZE]
+        url = OL_BASE + '/api/get_many?keys=' + json.dumps(batch, separators=(',', ':'))
+        response = get_json(url, session)
+        if response and response.get('status') == 'ok':
+            result.update(response['result'])
+    return result
+
+
+def get_ia_editions(iaids, session=None):
+    '''
+    Bulk version of get_ia_edition.  Returns a dict of IA identifier -> edition
+    (or None) for all of `iaids`.
+
+    Editions are looked up in batches through the Books API, then any redirect
+    records are resolved in a second batch.  Identifiers the Books API doesn't
+    know about fall back to get_ia_edition.  Results are memoized.
+    '''
+    todo = [i for i in set(iaids) if i not in _editions]
+    found = {}
+    for i in range(0, len(todo), BATCH_SIZE):
+        batch = todo[i:i + BATCH_SIZE]
+        url = OL_BASE + '/api/books.json?jscmd=details&bibkeys=' + ','.join('ia:' + ia for ia in batch)
+        books = get_json(url, session) or {}
+        for ia in batch:
+            details = books.get('ia:' + ia, {}).get('details')
+            if details:
+                found[ia] = details
+
+    redirects = dict((ia, e['location']) for ia, e in found.items() if is_redirect(e))
+    if redirects:
+        targets = get_many(set(redirects.values()), session)
+        for ia, location in redirects.items():
+            found[ia] = targets.get(location)
+
+    missing = [ia for ia in todo if ia not in found]
+    for ia, edition in zip(missing, fetch_all(lambda ia: get_ia_edition(ia, session), missing)):
+        found[ia] = edition
+    _editions.update(found)
+    return dict((ia, _editions[ia]) for ia in iaids)
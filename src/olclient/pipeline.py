@@ -0,0 +1,67 @@
+'''
+Staged processing pipelines built from chained generators.
+
+Each stage runs its function on a thread pool, preserving item order, and
+keeps counters so the report shows which stage dominates a run.  Stages
+read their input only as their output is consumed, so a fast stage can't
+run ahead of a slow one and fill memory.
+'''
+from __future__ import print_function
+
+import threading
+import timeit
+
+from .fetcher import ordered_map
+
+
+class Stage(object):
+    '''
+    One step of a pipeline.  `func` takes an item and returns a list of zero
+    or more items for the next stage, so a stage can filter (return []),
+    transform or fan out.  Items for which `skip(item)` is true are passed
+    through unchanged and not counted.
+    '''
+    def __init__(self, name, func, workers=1, skip=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.skip = skip
+        self.items_in = 0
+        self.items_out = 0
+        self.busy = 0.0 # seconds spent in func, summed over all workers
+        self.lock = threading.Lock()
+
+    def call(self, item):
+        if self.skip and self.skip(item):
+            return [item]
+        start = timeit.default_timer()
+        result = self.func(item)
+        elapsed = timeit.default_timer() - start
+        with self.lock:
+            self.items_in += 1
+            self.items_out += len(result)
+            self.busy += elapsed
+        return result
+
+    def __call__(self, items):
+        '''Generate the output items for an iterable of input items'''
+        if self.workers <= 1:
+            for item in items:
+                for result in self.call(item):
+                    yield result
+            return
+        for results in ordered_map(self.call, items, self.workers):
+            for result in results:
+                yield result
+
+    def report(self):
+        rate = self.items_in / self.busy if self.busy else 0
+        return '%-12s %6d in %6d out %8.1fs busy %8.1f items/s/worker' % (
+            self.name, self.items_in, self.items_out, self.busy, rate)
+
+
+def run_pipeline(items, stages):
+    '''Chain `stages` onto the `items` iterable and return the final generator'''
+    for stage in stages:
+        items = stage(items)
+    return items
@@ -0,0 +1,88 @@
+'''
+Per-host token bucket rate limiting for HTTP sessions.
+
+Limits are applied in a transport adapter, so only requests which actually
+go out over the network use up tokens; responses served from requests_cache
+never reach the adapter.
+'''
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    '''
+    Thread safe token bucket allowing `rate` acquisitions per second on
+    average with bursts of up to `capacity`.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a token is available and take it'''
+        while True:
+            with self.lock:
+                now = clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter(object):
+    '''
+    A token bucket per host.  `rates` maps domain names to requests/second and
+    applies to the domain and all its subdomains (so 'archive.org' covers the
+    ia*.us.archive.org servers that downloads get redirected to).  Hosts not
+    listed share the default rate individually.
+    '''
+    def __init__(self, rates=None, default=2.0, capacity=1):
+        self.rates = dict(rates or {})
+        self.default = default
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        domain = host
+        for d in self.rates:
+            if host == d or host.endswith('.' + d):
+                domain = d
+                break
+        with self.lock:
+            if domain not in self.buckets:
+                self.buckets[domain] = TokenBucket(self.rates.get(domain, self.default), self.capacity)
+            return self.buckets[domain]
+
+    def acquire(self, url):
+        self.bucket(urlsplit(url).hostname or '').acquire()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter which waits for a token from `limiter` before each request.
+    Set pool_maxsize to the number of worker threads so connections are
+    kept alive and reused rather than reopened.
+    '''
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire(request.url)
+        return super(RateLimitedAdapter, self).send(request, **kwargs)
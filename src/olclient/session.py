@@ -0,0 +1,100 @@
+'''
+The shared, cached and rate limited HTTP session used by all the scripts.
+'''
+from __future__ import print_function
+
+from collections import defaultdict
+import os
+import threading
+
+from .cachepolicy import CachePolicy, PolicySession
+from .fetcher import WORKERS, mount_rate_limiter
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+# One cache shared by every script, wherever it is run from
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cache')
+CACHE_NAME = os.path.join(CACHE_DIR, 'openlibrary')
+RATE = 2.0 # requests/second, default for any host
+RATES = {
+    'openlibrary.org': 2.0,
+    'archive.org': 4.0,
+}
+RETRIES = 3 # retries for connection errors and 429/5xx responses
+BACKOFF = 1.0 # seconds, doubled for each retry
+
+_session = None
+_lock = threading.Lock()
+
+
+class SessionStats(object):
+    '''Per-host request counters, collected by a response hook'''
+    FIELDS = ('requests', 'cached', 'fetched', 'errors', 'bytes', 'seconds')
+
+    def __init__(self):
+        self.hosts = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+        self.lock = threading.Lock()
+
+    def hook(self, response, **kwargs):
+        # Some requests_cache versions dispatch hooks twice for new responses
+        if getattr(response, 'counted', False):
+            return response
+        response.counted = True
+        host = urlsplit(response.url).hostname
+        with self.lock:
+            counts = self.hosts[host]
+            counts['requests'] += 1
+            if getattr(response, 'from_cache', False):
+                counts['cached'] += 1
+            else:
+                counts['fetched'] += 1
+                counts['seconds'] += response.elapsed.total_seconds()
+                counts['bytes'] += int(response.headers.get('content-length', 0) or 0)
+            if response.status_code >= 400:
+                counts['errors'] += 1
+        return response
+
+    def report(self):
+        lines = []
+        for host in sorted(self.hosts):
+            c = self.hosts[host]
+            lines.append('%s: %d requests, %d cached, %d fetched (%d bytes in %.1fs), %d errors' % (
+                host, c['requests'], c['cached'], c['fetched'], c['bytes'], c['seconds'], c['errors']))
+        return '\n'.join(lines)
+
+
+def make_session(cache_name=CACHE_NAME, rates=RATES, rate=RATE, workers=WORKERS, retries=RETRIES):
+    '''
+    Create a cached session which rate limits uncached requests per host,
+    retries transient failures with exponential backoff and keeps per-host
+    stats in session.stats.  The cache's expiry and size limits are managed
+    by session.policy.
+    '''
+    cache_dir = os.path.dirname(cache_name)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    session = PolicySession(cache_name)
+    session.policy = CachePolicy(session.cache, cache_name + '_policy.sqlite')
+    retry = Retry(total=retries, backoff_factor=BACKOFF, status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False) if retries else 0
+    session.limiter = mount_rate_limiter(session, rates, rate, workers, retry)
+    session.stats = SessionStats()
+    session.hooks = {'response': [session.stats.hook]}
+    return session
+
+
+def get_session():
+    '''Return the process wide shared session, creating it on first use'''
+    global _session
+    with _lock:
+        if _session is None:
+            _session = make_session()
+        return _session
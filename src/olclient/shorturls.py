@@ -0,0 +1,139 @@
+'''
+Persistent long URL -> short URL store, with bit.ly and offline shorteners.
+
+Short URLs never change, so once a URL has been shortened it's kept in a
+SQLite store keyed by the long URL alone (rather than only in the HTTP
+cache, keyed by an API URL which includes the credentials).  Batches are
+deduplicated against the store and only the misses are shortened,
+concurrently, with the session's rate limiting.
+
+Run as a script to import the short URLs from a TSV with alternating long
+and short URL columns, like data/SCCL-classic-eBooks-URLs-all.tsv:
+
+    python -m olclient.shorturls import data/SCCL-classic-eBooks-URLs-all.tsv
+'''
+from __future__ import print_function
+
+import hashlib
+import io
+import os
+import sqlite3
+import sys
+import threading
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from .fetcher import WORKERS, fetch_all
+from .session import CACHE_DIR, get_session
+
+STORE_NAME = 'shorturls.sqlite'
+BITLY_API = 'http://api.bit.ly/v3/shorten?login=%s&apiKey=%s&longUrl=%s'
+STUB_BASE = 'http://short.invalid/'
+
+
+class ShortURLStore(object):
+    '''
+    SQLite backed long -> short URL map.  Safe to share between threads.
+    '''
+    def __init__(self, filename=os.path.join(CACHE_DIR, STORE_NAME)):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS urls (long TEXT PRIMARY KEY, short TEXT, source TEXT)')
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+
+    def get(self, long_url):
+        with self.lock:
+            row = self.db.execute('SELECT short FROM urls WHERE long = ?', (long_url,)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, pairs, source):
+        '''Add (long, short) pairs, keeping any short URL already stored'''
+        with self.lock:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO urls VALUES (?, ?, ?)',
+                                    [(l, s, source) for l, s in pairs])
+
+    def put(self, long_url, short_url, source):
+        self.put_many([(long_url, short_url)], source)
+
+    def missing(self, long_urls):
+        '''Return the distinct URLs from long_urls which aren't in the store, in order'''
+        result = []
+        seen = set()
+        for url in long_urls:
+            if url not in seen:
+                seen.add(url)
+                if self.get(url) is None:
+                    result.append(url)
+        return result
+
+    def import_tsv(self, filename):
+        '''
+        Import from a TSV with a header row whose columns (after the first)
+        alternate long URL, short URL.  Returns the number of pairs read.
+        '''
+        pairs = []
+        with io.open(filename, encoding='utf-8') as f:
+            next(f)
+            for line in f:
+                columns = line.rstrip('\n').split('\t')[1:]
+                pairs.extend((l, s) for l, s in zip(columns[0::2], columns[1::2]) if l and s)
+        self.put_many(pairs, os.path.basename(filename))
+        return len(pairs)
+
+
+class BitlyShortener(object):
+    '''
+    Shorten URLs with the bit.ly v3 API.  Its responses bypass the HTTP cache
+    (see cachepolicy.POLICIES), as failures come back with an HTTP 200 and
+    the store keeps the successes.
+    '''
+    def __init__(self, login, api_key, session=None):
+        self.login = login
+        self.api_key = api_key
+        self.session = session or get_session()
+
+    def __call__(self, url):
+        response = self.session.get(BITLY_API % (self.login, self.api_key, quote(url)))
+        json = response.json()
+        if json['status_code'] != 200:
+            print('Failed to shorten URL ', url, response)
+            return None
+        return json['data']['url']
+
+
+class StubShortener(object):
+    '''Offline shortener for tests and benchmarks: a stable fake short URL per long URL'''
+    def __call__(self, url):
+        return STUB_BASE + hashlib.sha1(url.encode('utf-8')).hexdigest()[:7]
+
+
+def shorten_all(long_urls, shortener, store, workers=WORKERS):
+    '''
+    Return a dict of long -> short URL for long_urls, shortening only the
+    URLs which aren't already in the store, concurrently.  URLs which
+    couldn't be shortened map to None.
+    '''
+    misses = store.missing(long_urls)
+    shortened = fetch_all(shortener, misses, workers)
+    store.put_many([(l, s) for l, s in zip(misses, shortened) if s], type(shortener).__name__)
+    return dict((url, store.get(url)) for url in long_urls)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'import':
+        sys.exit('usage: python -m olclient.shorturls import file.tsv ...')
+    store = ShortURLStore()
+    for filename in sys.argv[2:]:
+        print('Imported %d URL pairs from %s' % (store.import_tsv(filename), filename))
+    print('%d URLs in store' % len(store))
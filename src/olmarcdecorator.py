@@ -4,250 +4,184 @@ download the IA MARC XML file and update it with our desired info.
 '''
 
 import codecs
-import xml.etree.ElementTree  as ET
-import pymarc
-from requests import ConnectionError
-import requests_cache
-import time
+from olclient import (CACHE_DIR, QUEUE_SIZE, WORKERS, BitlyShortener, ShortURLStore, StubShortener,
+                      RecordTransform, get_json, get_marc_xml, get_session, open_writers, ordered_map,
+                      shorten_all)
+import os
+import Queue
+import sys
+import threading
 import traceback
-import urllib
-from xml.sax import SAXParseException
 
-CACHE_DIR = '../cache/'
 DATA_DIR = '../data/'
-RATE = 2.0 # requests/second
+OUTPUT = DATA_DIR + 'SCCLclassics' # the extension comes from the format
+OUTPUT_FORMATS = ('marc',) # any of 'marc' (binary MARC21), 'xml' (MARCXML), 'jsonl' (MARC-in-JSON lines)
 FIELDS_REMOVED = ['583','596','852','856','699','790']
 count = 0
 
-requests_cache.install_cache('openlibrary')
-session = requests_cache.CachedSession()
+session = get_session()
+
+BITLY_CREDENTIALS = '../bitly_credentials.txt'
+BITLY_LOGIN = BITLY_API_KEY = None
+URLS_TSV = DATA_DIR + 'SCCL-classic-eBooks-URLs-all.tsv' # previously shortened URLs
+OFFLINE = False # True to use a stub shortener (and its own store) instead of bit.ly
+shortener = url_store = None
+
+def load_bitly_credentials(filename=BITLY_CREDENTIALS):
+    global BITLY_LOGIN, BITLY_API_KEY
+    bitly = file(filename).readlines()
+    BITLY_LOGIN = bitly[0].rstrip('\n').strip()
+    BITLY_API_KEY = bitly[1].rstrip('\n').strip()
+
+# Always available eBook links plus the series, subjects and uniform title
+# which identify the collection.  The 856 URLs are filled in per record.
+SCCL_TRANSFORM = {
+    # Internet Archive labels for 856s and any other unwanted fields
+    'remove': FIELDS_REMOVED,
+    'add': [
+        {'tag': '856', 'indicators': '40',
+         'subfields': [('u', '{epub}'), ('z', 'Always available eBooks (EPub)')]},
+        {'tag': '856', 'indicators': '40',
+         'subfields': [('u', '{kindle}'), ('z', 'Always available eBooks (Kindle)')]},
+        {'tag': '856', 'indicators': '40',
+         'subfields': [('u', '{ol}'), ('z', 'Always available eBooks (multiple formats)')]},
+        {'tag': u'490', 'indicators': '1 ', 'subfields': [(u'a', u'Rediscover the classics')]},
+        {'tag': u'655', 'indicators': ' 4', 'subfields': [(u'a', u'Electronic books.')]},
+        {'tag': u'655', 'indicators': ' 4', 'subfields': [(u'a', u'EBook classics.')]},
+        {'tag': u'830', 'indicators': ' 0', 'subfields': [(u'a', u'Rediscover the classics.')]},
+    ],
+}
+EPUB_URL = "https://archive.org/download/%s/%s.epub"
+KINDLE_URL = "https://www.amazon.com/gp/digital/fiona/web-to-kindle?clientid=IA&itemid=%s&docid=%s"
+transform = RecordTransform(SCCL_TRANSFORM)
 
-bitly = file('../bitly_credentials.txt').readlines()
-
-BITLY_LOGIN = bitly[0].rstrip('\n').strip()
-BITLY_API_KEY = bitly[1].rstrip('\n').strip()
-
-
-def make_throttle_hook(timeout=1.0):
-    """
-    Returns a response hook function which sleeps for `timeout` seconds if
-    response is not cached
-    """
-    def hook(response, **kwargs):
-        if not getattr(response, 'from_cache', False):
-            time.sleep(timeout)
-        return response
-    return hook
-
-session.hooks = {'response': make_throttle_hook(1.0/RATE)}
-
-def get_json(url):
-    response = session.get(url)
-    if response.status_code == 200:
-        edition = response.json()
-        return edition
+def update_marc_record(record,iaid,olurl):
+    '''Add our fields to a record, or return None if any of its URLs couldn't be shortened'''
+    # The URLs aren't checked before they're shortened.  For our initial project, all URLs
+    # except one succeeded and that was hand-verified to be an intermittent error, and the
+    # check caused more problems than it prevented due to IA instability.
+    epub, kindle, ol = shorten_urls([EPUB_URL % (iaid,iaid), KINDLE_URL % (iaid,iaid), olurl])
+    if None in (epub, kindle, ol):
+        return None
+    return transform(record, epub=epub, kindle=kindle, ol=ol)
+
+def setup_shortener():
+    global shortener, url_store
+    if OFFLINE:
+        shortener = StubShortener()
+        url_store = ShortURLStore(os.path.join(CACHE_DIR, 'shorturls-stub.sqlite'))
     else:
-        print 'Failed to get JSON for %s - status code %d' % (url,response.status_code)
-        
-def get_ia_edition(iaid):
-    '''Get JSON for an edition using its IA identifier.  Follows non-HTTP OpenLibrary redirect records '''
-    edition_url = 'http://openlibrary.org/books/ia:%s.json' % iaid
-    edition = get_json(edition_url)
-    if edition and 'type' in edition and 'key' in edition['type'] and edition['type']['key'] == '/type/redirect':
-        edition_url =  'http://openlibrary.org%s.json' % edition['location']
-        edition = get_json(edition_url)
-    return edition
+        load_bitly_credentials()
+        shortener = BitlyShortener(BITLY_LOGIN, BITLY_API_KEY, session)
+        url_store = ShortURLStore()
+        if not len(url_store) and os.path.exists(URLS_TSV):
+            print 'Imported %d URL pairs from %s' % (url_store.import_tsv(URLS_TSV), URLS_TSV)
 
-def get_file(iaid,suffix,body=False):
+def shorten_urls(urls):
+    '''
+    Return the short URLs for urls (None for any which couldn't be shortened).
+    Those not already in the store are shortened together, concurrently.
     '''
-    Test whether a file in the given format is available for an Internet Archive ID.
-    Follows redirects if necessary.
+    short_urls = dict((url, url_store.get(url)) for url in urls)
+    misses = [url for url in urls if short_urls[url] is None]
+    if misses:
+        short_urls.update(shorten_all(misses, shortener, url_store))
+        for url in misses:
+            if short_urls[url]:
+                print url,'\t',short_urls[url]
+    return [short_urls[url] for url in urls]
     
-    If the "suffix" parameter doesn't contain a period, one will be prepended.
-    This allows both "epub" and "_files.xml" style suffixes.
-
-    if body=False (default), the content will not be fetched.  Redirects are followed and the
-    final URL is returned.  If this is True, the actual content will be fetched and returned.
+def fetch_marc_record(ia):
+    # This is the Internet Archive version of the MARC record for the electronic version e.g.
+    #   https://archive.org/download/myantonia00cathrich/myantonia00cathrich_archive_marc.xml
+    # not the original libraries MARC record for the paper book e.g.
+    #   https://archive.org/download/myantonia00cathrich/myantonia00cathrich_marc.xml
+    marcurl = 'http://archive.org/download/%s/%s_archive_marc.xml' % (ia,ia)
+    records = get_marc_xml(ia, session=session)
+    return records[0] if records else None, marcurl
+
+def enrich(url):
+    '''
+    Fetch and update the MARC record for one OpenLibrary edition URL.
+    Returns (url, record or None, message) and runs on the worker threads.
+    '''
+    jsonurl = '/'.join(url.split('/')[0:5])+'.json'
+    json = get_json(jsonurl)
+    if not json or 'ocaid' not in json:
+        return url, None, '** Unexpectedly missing ocaid for ' + jsonurl
+    ia = json['ocaid']
+    record, marcurl = fetch_marc_record(ia)
+    if record is None:
+        return url, None, '** failed to fetch MARC record for ' + marcurl
+    record = update_marc_record(record,ia,url)
+    if record is None:
+        return url, None, '** failed to shorten the URLs for ' + url
+    return url, record, marcurl
+
+def write_records(writers, queue, counts):
+    '''
+    Writer thread: write records from the queue, in order, until a None.
+    Records which can't be encoded are skipped.  If writing fails the
+    traceback is left in counts['error'] for the main thread, and the queue
+    is drained so that it never blocks.
     '''
-    #files = session.get('http://archive.org/download/%s/%s_files.xml' % (iaid,iaid))
-    if suffix.find('.') < 0:
-        suffix = '.'+suffix
-    url = 'http://archive.org/download/%s/%s%s' % (iaid,iaid,suffix)
-
-    try:
-        if not body:
-            epub = session.head(url)
-        else:
-            epub = session.get(url)
-        
-        if epub.status_code == 302:
-            url = epub.headers['location']
-            #print 'Redirecting to ',url
-            if not body:
-                epub = session.head(url)
-            else:
-                epub = session.get(url)
-        if epub.status_code == 200:
-            return epub if body else url
-        elif epub.status_code != 403:
-            print 'HTTP error (%d) fetching %s for %s from %s ' % (epub.status_code,suffix,iaid,url)
-    except ConnectionError as e:
-        print 'Error fetching URL: ',url,e
-    return None
-
-def rate_wait(time):
-    last = now()
     while True:
-        yield()
-    
-def get_files(ia):
-    suffix = '_files.xml'
-    filename = CACHE_DIR + ia + suffix
-    root = None
-    
-    # check cache
-    try:
-        with file(filename, 'r') as cachefile:
-            root = ET.parse(cachefile).getroot()
-    except IOError:
-        files_xml =  get_file(ia,suffix,body=True)
-        if files_xml and files_xml.status_code == 200:
-            with file(filename, 'w') as output:
-                output.write(files_xml.content)
-            root = ET.fromstring(files_xml.content)
-    if root is not None:
-        files = [f.get('name') for f in root.findall('file')]
-        return files
+        item = queue.get()
+        if item is None:
+            break
+        if 'error' in counts:
+            continue
+        record, marcurl = item
+        # Encode for every format before writing any, so all the outputs stay valid and in step
+        try:
+            encoded = [writer.encode(record) for writer in writers]
+        except Exception:
+            print '** failed to write MARC record for ',marcurl
+            print traceback.format_exc()
+            continue
+        try:
+            for writer, data in zip(writers, encoded):
+                writer.write_data(data)
+        except Exception:
+            counts['error'] = traceback.format_exc()
+            continue
+        counts['written'] += 1
 
-def find_file(files,suffix):
-    if files and suffix:
-        for f in files:
-            if f[-len(suffix):len(f)] == suffix:
-                return f
-
-def url_field(url,tag):
-    return pymarc.Field(
-        tag = '856',
-        indicators = ['4','0'],
-        subfields = [
-            'u', url,
-            'z', 'Always available eBooks (%s)' % tag,
-        ])
-
-def add_url(record, url,tag):
-    # Amazon will return 405 for a HEAD verb, so just skip the check
-    # it's a service which should always be available anyway
-    skip_check = url.find("amazon.com") > 0
-    
-    # For our initial project, all URLs except one succeeded and that was hand-verified
-    # to be an intermittent error, so we're going to skip this check for now because  its
-    # causing more problems than it's designed to prevent due to IA instability
-    skip_check = True
-    
-    if not skip_check:
-        response = session.head(url)
-        if response.status_code == 302:
-            response = session.head(response.headers['Location'])
-    if skip_check or response.status_code == 200:
-        short_url = shorten_url(url)
-        record.add_ordered_field(url_field(short_url, tag))
-    else:
-        print "Unable to resolve URL: ",url, response
-
-def add_subject(record, subject):
-    record.add_ordered_field(pymarc.Field(
-                                tag = u'655',
-                                indicators = [' ', '4'],
-                                subfields = [
-                                    u'a', subject,
-                                ])
-                             )
-
-def update_marc_record(record,iaid,olurl):
-    # Delete Internet Archive labels for 856s and any other unwanted fields
-    for code in FIELDS_REMOVED:
-        for field in record.get_fields(code):
-            record.remove_field(field)
-    
-    add_url(record, "https://archive.org/download/%s/%s.epub" % (iaid,iaid),"EPub")
-    add_url(record, "https://www.amazon.com/gp/digital/fiona/web-to-kindle?clientid=IA&itemid=%s&docid=%s" % (iaid, iaid),"Kindle")
-    add_url(record, olurl,"multiple formats")
-
-    # Add a series
-    record.add_ordered_field(pymarc.Field(
-                                tag = u'490',
-                                indicators = ['1',' '],
-                                subfields = [
-                                    u'a', u'Rediscover the classics',
-                                ])
-                     )
-    # Add a couple new subjects
-    add_subject(record, u'Electronic books.')
-    add_subject(record,  u'EBook classics.')
-
-    # Add additional Uniform Title
-    record.add_ordered_field(pymarc.Field(
-                                tag = u'830',
-                                indicators = [' ','0'],
-                                subfields = [
-                                    u'a', u'Rediscover the classics.',
-                                ])
-                     )
-    return record
-
-def shorten_url(url):
-    template = 'http://api.bit.ly/v3/shorten?login=%s&apiKey=%s&longUrl=%s'
-    url = urllib.quote(url)
-    requesturl = template % (BITLY_LOGIN, BITLY_API_KEY, url)
-    response = session.get(requesturl)
-    json = response.json()
-    if json['status_code'] != 200:
-        print 'Failed to shorten URL ', url, response
-    else:
-        short_url = json['data']['url']
-        print url,'\t',short_url
-        return short_url
-    
 def main():
-#    with pymarc.MARCWriter(file(DATA_DIR+'SCCLclassics.mrc','wb')) as writer:
-    writer = pymarc.MARCWriter(codecs.open(DATA_DIR+'SCCLclassics.mrc','w','utf-8'))
-    count = written = 0
-    for line in codecs.open(DATA_DIR+'SCCL classics candidates - v3 selected.tsv', encoding='utf-8'):
-        count += 1
-        if count < 2:
-            continue # skip header line
-        url = line.rstrip('\n').split('\t')[6].replace('https:','http:')
-        print '  ',url
-        jsonurl = '/'.join(url.split('/')[0:5])+'.json'
-        json = get_json(jsonurl)
-        if 'ocaid' in json:
-            ia = json['ocaid']
-            # This is the Internet Archive version of the MARC record for the electronic version e.g.
-            #   https://archive.org/download/myantonia00cathrich/myantonia00cathrich_archive_marc.xml
-            # not the original libraries MARC record for the paper book e.g.
-            #   https://archive.org/download/myantonia00cathrich/myantonia00cathrich_marc.xml
-            marcurl = 'http://archive.org/download/%s/%s_archive_marc.xml' % (ia,ia)
-            records = None
-            retries = 0
-            while retries < 3 and records == None:
-                retries += 1
-                try:
-                    records = pymarc.parse_xml_to_array(marcurl)
-                except SAXParseException:
-                    records = None
-            record = update_marc_record(records[0],ia,url)
-#            record.force_utf8 = True
-            try:
-                writer.write(record)
-                written += 1
-            except:
-                print '** failed to write MARC record for ',marcurl
-                print traceback.format_exc()
-                #for field in record.fields:
-                #    print str(field)
-        else:
-            print '** Unexpectedly missing ocaid for ',jsonurl
-    writer.close()
-    print 'Wrote %d of %d MARC records' % (written, count-1)
-
-main()
+    setup_shortener()
+    writers = open_writers(OUTPUT, OUTPUT_FORMATS)
+    count = 0
+    counts = {'written': 0}
+    lines = codecs.open(DATA_DIR+'SCCL classics candidates - v3 selected.tsv', encoding='utf-8')
+    lines.next() # skip header line
+    urls = (line.rstrip('\n').split('\t')[6].replace('https:','http:') for line in lines)
+    # Records are fetched and updated on the worker threads and handed, in
+    # input order, through a bounded queue to a single writer thread
+    queue = Queue.Queue(QUEUE_SIZE)
+    writer_thread = threading.Thread(target=write_records, args=(writers, queue, counts))
+    writer_thread.start()
+    try:
+        for url, record, message in ordered_map(enrich, urls, WORKERS, QUEUE_SIZE):
+            if 'error' in counts:
+                break
+            count += 1
+            print '  ',url
+            if record is None:
+                print message
+            else:
+                queue.put((record, message))
+    finally:
+        queue.put(None)
+        writer_thread.join()
+        for writer in writers:
+            writer.close()
+    if 'error' in counts:
+        sys.exit('** failed writing MARC records, output is incomplete\n' + counts['error'])
+    print 'Wrote %d of %d MARC records' % (counts['written'], count)
+    for writer in writers:
+        print writer.report()
+    print session.stats.report()
+    print session.policy.report()
+
+if __name__ == '__main__':
+    main()
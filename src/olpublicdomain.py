@@ -4,32 +4,11 @@ OpenLibrary records with full text available on Internet Archive.
 '''
 
 import codecs
-import xml.etree.ElementTree  as ET
-import pymarc
-from requests import ConnectionError
-import requests_cache
-import time
+from olclient import Stage, WORKERS, get_ia_editions, get_session, item_file, probe_008, run_pipeline
 
-CACHE_DIR = '../cache/'
 DATA_DIR = '../data/'
-RATE = 2.0 # requests/second
-count = 0
 
-requests_cache.install_cache('openlibrary')
-session = requests_cache.CachedSession()
-    
-def make_throttle_hook(timeout=1.0):
-    """
-    Returns a response hook function which sleeps for `timeout` seconds if
-    response is not cached
-    """
-    def hook(response, **kwargs):
-        if not getattr(response, 'from_cache', False):
-            time.sleep(timeout)
-        return response
-    return hook
-
-session.hooks = {'response': make_throttle_hook(1.0/RATE)}
+session = get_session()
 
 def search_open_library(author,title, language):
     result = []
@@ -49,22 +28,6 @@ def search_open_library(author,title, language):
     return result
 
 
-def check_language(lang,doc):
-    if 'language' in doc:
-        if  lang in doc['language']:
-            return True
-        else:
-            print 'Non-English version ',doc['key'],doc['language']
-    else:
-        # TODO:
-        #aid = doc['ocaid']
-        #marc_url = 'https://archive.org/download/%s/%s_marc.xml' % (aid,aid)
-        # download MARC
-        # check for 'English' in 240$l
-        
-        print 'Unknown language ',doc['key']
-        return False
-
 def all_editions(doc):
     '''
     Merge the contents of the two IA editions fields
@@ -77,65 +40,6 @@ def all_editions(doc):
     print len(editions), ' editions'
     return editions
 
-def get_json(url):
-    response = session.get(url)
-    if response.status_code == 200:
-        edition = response.json()
-        return edition
-    else:
-        print 'Failed to get JSON for %s - status code %d' % (url,response.status_code)
-        
-def get_ia_edition(iaid):
-    '''Get JSON for an edition using its IA identifier.  Follows non-HTTP OpenLibrary redirect records '''
-    edition_url = 'http://openlibrary.org/books/ia:%s.json' % iaid
-    edition = get_json(edition_url)
-    if edition and 'type' in edition and 'key' in edition['type'] and edition['type']['key'] == '/type/redirect':
-        edition_url =  'http://openlibrary.org%s.json' % edition['location']
-        edition = get_json(edition_url)
-    return edition
-
-def get_file(iaid,suffix,body=False):
-    '''
-    Test whether a file in the given format is available for an Internet Archive ID.
-    Follows redirects if necessary.
-    
-    If the "suffix" parameter doesn't contain a period, one will be prepended.
-    This allows both "epub" and "_files.xml" style suffixes.
-
-    if body=False (default), the content will not be fetched.  Redirects are followed and the
-    final URL is returned.  If this is false, the actual content will be fetched and returned.
-    '''
-    #files = session.get('http://archive.org/download/%s/%s_files.xml' % (iaid,iaid))
-    if suffix.find('.') < 0:
-        suffix = '.'+suffix
-    url = 'http://archive.org/download/%s/%s%s' % (iaid,iaid,suffix)
-
-    try:
-        if not body:
-            epub = session.head(url)
-        else:
-            epub = session.get(url)
-        
-        if epub.status_code == 302:
-            url = epub.headers['location']
-            #print 'Redirecting to ',url
-            if not body:
-                epub = session.head(url)
-            else:
-                epub = session.get(url)
-        if epub.status_code == 200:
-            return epub if body else url
-        elif epub.status_code != 403:
-            print 'HTTP error (%d) fetching %s for %s from %s ' % (epub.status_code,suffix,iaid,url)
-    except ConnectionError as e:
-        print 'Error fetching URL: ',url,e
-    return None
-
-def rate_wait(time):
-    last = now()
-    while True:
-        yield()
-
 def merge(base, added):
     keys = [b['key'] for b in base]
     base += [a for a in added if not a['key'] in keys]
@@ -149,100 +53,130 @@ def publicdomain(date):
     except ValueError:
         return False
     
-def get_files(ia):
-    suffix = '_files.xml'
-    filename = CACHE_DIR + ia + suffix
-    root = None
-    
-    # check cache
-    try:
-        with file(filename, 'r') as cachefile:
-            root = ET.parse(cachefile).getroot()
-    except IOError:
-        files_xml =  get_file(ia,suffix,body=True)
-        if files_xml and files_xml.status_code == 200:
-            with file(filename, 'w') as output:
-                output.write(files_xml.content)
-            root = ET.fromstring(files_xml.content)
-    if root is not None:
-        files = [f.get('name') for f in root.findall('file')]
-        return files
-
-def find_file(files,suffix):
-    if files and suffix:
-        for f in files:
-            if f[-len(suffix):len(f)] == suffix:
-                return f
         
+def work_may_qualify(lang, doc):
+    '''
+    Cheap check using only the search result fields.  Rules out works whose
+    language is known and doesn't include `lang`, or which were first
+    published too late for any of their editions to be public domain.
+    Works with no language listed are kept; marc_stage checks each
+    edition's language in its MARC 008 field.
+    '''
+    if 'language' in doc and lang not in doc['language']:
+        print 'Non-English work ',doc['key'],doc['language']
+        return False
+    year = doc.get('first_publish_year')
+    if year and not publicdomain(year):
+        print 'First published %s ' % year,doc['key']
+        return False
+    return True
+
+def read_titles(filename):
+    for count, line in enumerate(codecs.open(filename, encoding='utf-8')):
+        if count == 0:
+            continue # skip header line
+        title,author,work_title = line.rstrip('\n').split('\t')
+        title = title.split(':')[0].strip() # main title only
+        yield {'title': title, 'author': author, 'work_title': work_title}
+
+# Pipeline stages.  Each takes a dict for one title or edition and returns a
+# list of dicts for the next stage (empty to drop it).  Once an item has its
+# output 'row' it passes straight through the remaining stages.
+
+def search_stage(item):
+    title, author, work_title = item['title'], item['author'], item['work_title']
+    docs = search_open_library(author, title, 'eng')
+    print '\n%d OpenLibrary works found for %s by %s:' % (len(docs),title,author)
+
+    if work_title and work_title != title:
+        before = len(docs)
+        docs = merge(docs,search_open_library(author, title, 'eng'))
+        added = len(docs) - before
+        if added:
+            print 'Added %d new search results' % added
+
+    if not docs:
+        # Output a blank record so we know it got no matches
+        print 'No matches for %s by %s' % (title, author)
+        item['row'] = [title, author]
+    item['docs'] = docs
+    return [item]
+
+def works_stage(item):
+    item['docs'] = [doc for doc in item['docs'] if work_may_qualify('eng', doc)]
+    return [item] if item['docs'] else []
+
+def editions_stage(item):
+    # Resolve the editions of all the works for this title in bulk
+    doc_editions = [all_editions(doc) for doc in item['docs']]
+    editions = get_ia_editions(set().union(*doc_editions))
+    result = []
+    for e in sorted(editions):
+        edition = editions[e]
+        if edition and 'ocaid' in edition:
+            result.append({'title': item['title'], 'author': item['author'], 'edition': edition,
+                           'ia': edition['ocaid'], 'key': edition['key'],
+                           'date': edition['publish_date'] if 'publish_date' in edition else ''})
+        else:
+            print 'OL edition record unexpectedly missing "ocaid" key',edition
+    return result
+
+def date_stage(item):
+    return [item] if publicdomain(item['date']) else []
+
+def files_stage(item):
+    # ePub is not listed typically
+    abbyy_url = item_file(item['ia'],'_abbyy.gz')
+    marc_url = item_file(item['ia'],'_meta.mrc')
+    if abbyy_url and marc_url:
+        item['marc_url'] = marc_url
+        return [item]
+    print 'Skipping ',item['ia'],item['key'],abbyy_url,marc_url
+    return []
+
+def marc_stage(item):
+    # Only the leader, directory and 008 field are fetched
+    try:
+        yrlang = probe_008(item['ia'])
+    except ValueError:
+        print 'Failed to parse MARC record ',item['marc_url']
+        return []
+    if not yrlang:
+        print 'No MARC record ',item['ia'],item['key']
+        return []
+    yr, lang = yrlang
+    print yr, lang
+    if lang != 'eng':
+        print 'Skipping lang: ',lang
+        return []
+    # We have a winner!
+    ol_edition_url = 'http://openlibrary.org' + item['key']
+    item['row'] = [item['title'], item['author'], item['date'], ol_edition_url]
+    return [item]
+
 def main():
+    finished = lambda item: 'row' in item
+    # Cheap filters go first so the network bound stages only see survivors
+    stages = [
+        Stage('search', search_stage, WORKERS, finished),
+        Stage('works', works_stage, 1, finished),
+        Stage('editions', editions_stage, 1, finished),
+        Stage('date', date_stage, 1, finished),
+        Stage('files', files_stage, WORKERS, finished),
+        Stage('marc', marc_stage, WORKERS, finished),
+    ]
+    count = 0
     with codecs.open(DATA_DIR+'SCCL-classics-ebook-candidates.tsv','w',encoding='utf-8') as output:
-        count = 0
-        for line in codecs.open(DATA_DIR+'SCCL-classics-edition-author-work.tsv', encoding='utf-8'):
+        titles = read_titles(DATA_DIR+'SCCL-classics-edition-author-work.tsv')
+        for item in run_pipeline(titles, stages):
+            output.write('\t'.join(item['row'])+'\n')
             count += 1
-            if count == 1:
-                continue # skip header line
-            title,author,work_title = line.rstrip('\n').split('\t')
-            title = title.split(':')[0].strip() # main title only
-            docs = search_open_library(author, title, 'eng')
-            print '\n%d OpenLibrary works found for %s by %s:' % (len(docs),title,author)
-            
-            if work_title and work_title != title:
-                before = len(docs)
-                docs = merge(docs,search_open_library(author, title, 'eng'))
-                added = len(docs) - before
-                if added:
-                    print 'Added %d new search results' % added
- 
-            if not docs:
-                # Output a blank record so we know it got no matches
-                print 'No matches for %s by %s' % (title, author)
-                output.write('\t'.join([title, author])+'\n')
-            for doc in docs:
-                key = doc['key']
-                #if not 'public_scan_b' in doc or doc['public_scan_b']: # not reliable
-                if True or check_language('eng',doc):
-                    nonIA = 0
-                    for e in all_editions(doc):
-                        edition = get_ia_edition(e)
-                        if edition and 'ocaid' in edition:
-                            ia = edition['ocaid']
-                            key = edition['key']
-                            date = edition['publish_date'] if 'publish_date' in edition else ''
-                            if publicdomain(date):
-                                #print date
-                                files = get_files(ia)
-                                # ePub is not listed typically
-                                #epub_url = find_file(files,'epub')
-                                abbyy_url = find_file(files,'_abbyy.gz')
-                                marc_url = find_file(files,'_meta.mrc')
-                                if abbyy_url and marc_url:
-                                    response = get_file(ia,'_meta.mrc',body=True)
-                                    if response and response.status_code == 200:
-                                        try:
-                                            marcfile = pymarc.MARCReader(response.content)
-                                            marc = marcfile.next()
-                                            field = marc['008'].value()
-                                            yr = field[7:11]
-                                            lang = field[35:38]
-                                            print yr, lang
-                                            ol_edition_url = 'http://openlibrary.org' + key
-                                            #print '\t'.join([ date, ol_edition_url, epub_url])
-                                            if lang == 'eng':
-                                                # We have a winner! - write it to our output file.
-                                                output.write('\t'.join([title, author, date, ol_edition_url])+'\n')
-                                            else:
-                                                print 'Skipping lang: ',lang
-                                        except:
-                                            print 'Failed to parse MARC record ',marc_url
-                                    else:
-                                        print 'No MARC record ',ia,key
-                                else:
-                                    print 'Skipping ',ia,key,abbyy_url,marc_url
-                        else:
-                            nonIA += 1
-                            print 'OL edition record unexpectedly missing "ocaid" key',edition
-                    # print 'Editions with no IA equiv = %d' % nonIA
-
-    print count,title,author
-
-main()
+
+    print 'Wrote %d rows' % count
+    for stage in stages:
+        print stage.report()
+    print session.stats.report()
+    print session.policy.report()
+
+if __name__ == '__main__':
+    main()
@@ -10,58 +10,45 @@ Created on 2017-04-04
 
 import datetime
 import matplotlib.pyplot as plt
-import requests
-import requests_cache
+import numpy
+import os
+import sys
 
-requests_cache.install_cache('openlibrary_cache')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from charts import PERIODS, plot_series
+from recentchanges import CUTOFF, SeriesStore
+from spamindex import SpamIndex
 
-BASE='https://openlibrary.org'
-CHANGES = BASE + '/recentchanges/%04d/%02d/%02d/'
-LIMIT=1000
-MAX= 10000 # 10000
 START = datetime.datetime(2009, 3, 15)
 END = datetime.datetime.today() + datetime.timedelta(days = 1)
-CUTOFF = datetime.datetime(2011, 6, 9)
+FREQ = None # or 'W' / 'M' to plot weekly or monthly totals
+WINDOW = 28 # periods in the rolling mean
+OUTPUT = 'openlibrary-accounts.svg' # .svg or .png
 CLIP = 2700
-counts = []
-dates = []
-outliers = []
 
-date = START
-while date < END:
-    count = 0
-    # Before 2011 it's 'create' then 'register' not 'new-account'
-    if date < CUTOFF:
-        kind = 'register'
-    else:
-        kind = 'new-account'
-    url = (CHANGES % (date.year, date.month, date.day)) + kind + '.json'
-    for offset in range(0, MAX-LIMIT, LIMIT):
-        params = {'offset': offset, 'limit' : LIMIT}
-        # TODO: In production, don't use cache for recentchange list
-        response = requests.get(url, params = params)
-        if not response.ok:
-            print('Failed to fetch url %d %s' % (response.status_code, url))
-            break
-        accounts = response.json()
-        count += len(accounts)
-        if len(accounts) < LIMIT: # short read means we're done
-            break
-    dates.append(date)
-    counts.append(min(count, CLIP))
-    if count > CLIP:
-        print(date, count)
-        outliers.append((len(dates), count))
-    
-    #print('%s\t%d' % (date.isoformat(), count))
-    date += datetime.timedelta(days = 1)
-
-fig = plt.figure()
-ax = fig.add_subplot(111)
-
-ax.plot(dates, counts)
-plt.ylabel('New OpenLibrary accounts / day')
-#ax.annotate('Outlier = %d' % outliers[0][1], xy=(outliers[0][0],200), xytext=(10,10),
-#            arrowprops=dict(facecolor='black', shrink=0.05))
-fig.savefig('openlibrary-accounts.svg',format='svg')
+# Counts come from the series store, refresh it with: python recentchanges.py update
+# Before 2011 it's 'create' then 'register' not 'new-account'
+store = SeriesStore()
+old_dates, old_daily = store.read('register', START, CUTOFF)
+new_dates, new_daily = store.read('new-account', CUTOFF, END)
+dates = numpy.concatenate((old_dates, new_dates))
+daily = numpy.concatenate((old_daily, new_daily))
+if not len(dates):
+    sys.exit('No account counts stored, run: python recentchanges.py update register new-account')
+
+# Known spammers (see spamindex.py) by the day their first reverted change was
+# made, which is usually the day they signed up
+spam_dates, spam_daily = SpamIndex().first_seen_by_day()
+spam = numpy.zeros_like(daily)
+i = numpy.searchsorted(dates, spam_dates)
+found = i < len(dates)
+found[found] = dates[i[found]] == spam_dates[found]
+numpy.add.at(spam, i[found], spam_daily[found])
+print('%d of %d new accounts are known spammers' % (spam.sum(), daily.sum()))
+daily = numpy.maximum(daily - spam, 0)
+for i in numpy.flatnonzero(daily > CLIP):
+    print(dates[i], daily[i])
+
+plot_series(dates, daily, 'New OpenLibrary accounts / %s (excluding known spammers)' % PERIODS[FREQ], OUTPUT, freq=FREQ, window=WINDOW,
+            clip=None if FREQ else CLIP)
 plt.show()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregation and plotting for the daily count series.
+
+Everything works on NumPy arrays of datetime64[D] dates and integer counts,
+as returned by recentchanges.SeriesStore.read(): resampling to weekly or
+monthly totals, rolling means and outlier detection are vectorized, and
+plots are downsampled before they're drawn so the size of a chart doesn't
+grow with the length of the series.
+
+@author: Tom Morris <tfmorris@gmail.com>
+@copyright 2015,2017 Thomas F. Morris
+"""
+
+from __future__ import print_function
+import os
+
+import matplotlib
+import numpy
+
+MAX_POINTS = 1000 # most points drawn per line
+OUTLIER_K = 5.0 # outliers are more than this many (robust) deviations above the rolling mean
+MIN_SPREAD = 0.1 # smallest deviation used, as a fraction of the median
+PERIODS = {None: 'day', 'W': 'week', 'M': 'month'} # resampling frequencies
+MONDAY = numpy.timedelta64(4, 'D') # datetime64 weeks start on Thursdays, like 1970-01-01
+
+
+def resample(dates, counts, freq):
+    '''
+    Sum daily counts by week ('W', starting Mondays) or month ('M').
+    Returns (period start dates, totals).
+    '''
+    if freq == 'W':
+        periods = (dates - MONDAY).astype('datetime64[W]').astype('datetime64[D]') + MONDAY
+    elif freq == 'M':
+        periods = dates.astype('datetime64[M]').astype('datetime64[D]')
+    else:
+        raise ValueError('Unknown frequency %s' % freq)
+    starts, index = numpy.unique(periods, return_inverse=True)
+    return starts, numpy.bincount(index.ravel(), weights=counts).astype(counts.dtype)
+
+
+def rolling_mean(counts, window):
+    '''Trailing mean over `window` points, NaN until the window is full'''
+    means = numpy.full(len(counts), numpy.nan)
+    if len(counts) >= window:
+        sums = numpy.cumsum(numpy.concatenate(([0], counts)), dtype=numpy.float64)
+        means[window - 1:] = (sums[window:] - sums[:-window]) / window
+    return means
+
+
+def outliers(counts, window, k=OUTLIER_K):
+    '''
+    Return the indices of counts which are more than k (robust) standard
+    deviations above the rolling mean.  The deviation is estimated from the
+    median absolute deviation, but taken as at least MIN_SPREAD of the
+    median count so that very smooth series don't flag small bumps.
+    '''
+    residuals = counts - rolling_mean(counts, window)
+    valid = ~numpy.isnan(residuals)
+    if not valid.any():
+        return numpy.array([], dtype=numpy.intp)
+    median = numpy.median(residuals[valid])
+    spread = max(1.4826 * numpy.median(numpy.abs(residuals[valid] - median)),
+                 MIN_SPREAD * numpy.median(counts), 1.0)
+    return numpy.flatnonzero(valid & (residuals - median > k * spread))
+
+
+def downsample(dates, values, max_points=MAX_POINTS):
+    '''
+    Reduce a series to about max_points by keeping the minimum and maximum
+    of each bucket of consecutive points, so spikes survive.
+    '''
+    n = len(values)
+    if n <= max_points:
+        return dates, values
+    size = int(numpy.ceil(2.0 * n / max_points))
+    buckets = numpy.arange(0, n, size)
+    # position of the min and max within each bucket, padding the last with its final value
+    padded = numpy.concatenate((values, numpy.repeat(values[-1:], len(buckets) * size - n)))
+    padded = padded.reshape(-1, size)
+    lo = buckets + numpy.argmin(padded, axis=1)
+    hi = buckets + numpy.argmax(padded, axis=1)
+    keep = numpy.unique(numpy.minimum(numpy.concatenate((lo, hi)), n - 1))
+    return dates[keep], values[keep]
+
+
+def plot_series(dates, counts, ylabel, filename, freq=None, window=None, clip=None, max_points=MAX_POINTS):
+    '''
+    Plot a daily series, optionally resampled to `freq` with a rolling mean
+    over `window` periods, and save it to filename (PNG or SVG depending on
+    the extension).  Values above `clip` are cut off and outliers are
+    annotated with their actual values.  Returns the figure.
+    '''
+    import matplotlib.pyplot as plt
+    if freq:
+        dates, counts = resample(dates, counts, freq)
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    shown = numpy.minimum(counts, clip) if clip else counts
+    ax.plot(*downsample(dates, shown, max_points), linewidth=0.5)
+    if window:
+        means = rolling_mean(counts, window)
+        full = ~numpy.isnan(means)
+        ax.plot(*downsample(dates[full], means[full], max_points), linewidth=1.0)
+        spikes = outliers(counts, window)
+        # Label the largest few so the annotations stay legible
+        for i in spikes[numpy.argsort(counts[spikes])[::-1][:5]]:
+            ax.annotate('%s: %d' % (dates[i], counts[i]), xy=(dates[i], shown[i]), xytext=(5, -5),
+                        textcoords='offset points', fontsize='x-small')
+    plt.ylabel(ylabel)
+    fig.autofmt_xdate()
+    fmt = os.path.splitext(filename)[1].lstrip('.') or 'png'
+    # Text as text rather than glyph paths, and merge nearly collinear segments
+    with matplotlib.rc_context({'svg.fonttype': 'none', 'path.simplify': True,
+                                'path.simplify_threshold': 1.0}):
+        fig.savefig(filename, format=fmt)
+    return fig
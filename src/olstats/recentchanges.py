@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Daily count series from the OpenLibrary recentchanges API.
+
+Counts the changes of each kind (add-book, new-account, register, revert)
+per day and keeps them in a SQLite series store, so charts are just a read
+of the store.  Days are fetched concurrently on a worker pool (all requests
+going through the shared rate limited session).  Days which are final, i.e.
+far enough in the past that no more changes will be recorded for them, are
+never fetched again, so an update only fetches new or recent days.
+
+Bring all the series up to date with:
+
+    python recentchanges.py update
+
+@author: Tom Morris <tfmorris@gmail.com>
+@copyright 2015,2017 Thomas F. Morris
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from olclient import CACHE_DIR, WORKERS, get_session, ordered_map
+
+BASE = 'https://openlibrary.org'
+CHANGES = BASE + '/recentchanges/%04d/%02d/%02d/'
+LIMIT = 1000 # the most the API will return at once
+MIN_LIMIT = 100
+FINAL_AFTER = datetime.timedelta(days=2) # days older than this won't change
+SERIES_DB = os.path.join(CACHE_DIR, 'olstats.sqlite')
+SAVE_EVERY = 50 # days between commits
+CHUNK_SIZE = 64 * 1024
+DEPTH_STEP = numpy.zeros(256, numpy.int8)
+DEPTH_STEP[bytearray(b'[{')] = 1
+DEPTH_STEP[bytearray(b']}')] = -1
+BLANK = numpy.zeros(256, bool)
+BLANK[bytearray(b' \t\r\n')] = True
+COMMA = ord(',')
+OPEN_ARRAY = ord('[')
+CUTOFF = datetime.datetime(2011, 6, 9) # Before this accounts were 'register' not 'new-account'
+# kind: (first day, end day or None for today)
+SERIES = {
+    'add-book': (datetime.datetime(2010, 8, 1), None),
+    'new-account': (CUTOFF, None),
+    'register': (datetime.datetime(2009, 3, 15), CUTOFF),
+    'revert': (datetime.datetime(2011, 4, 20), None),
+}
+
+
+def daterange(start, end):
+    date = start
+    while date < end:
+        yield date
+        date += datetime.timedelta(days=1)
+
+
+def count_array(chunks):
+    '''
+    Count the elements of a JSON array arriving as an iterable of byte
+    chunks, without building the elements.  Strings are cut out by splitting
+    on quotes (after dropping escapes), then the nesting depth of what's
+    left is a cumulative sum, and elements are the commas at depth 1.
+    '''
+    opened = closed = nonempty = False
+    depth = commas = 0
+    carry = b''
+    for chunk in chunks:
+        parts = (carry + chunk).replace(b'\\\\', b'').replace(b'\\"', b'').split(b'"')
+        # an odd number of quotes means the last string continues in the next chunk
+        carry = b'"' + parts.pop() if len(parts) % 2 == 0 else b''
+        shape = numpy.frombuffer(b'x'.join(parts[0::2]), numpy.uint8)
+        if not opened:
+            start = numpy.flatnonzero(~BLANK[shape])
+            if not len(start):
+                continue
+            if shape[start[0]] != OPEN_ARRAY:
+                raise ValueError('Not a JSON array')
+            shape = shape[start[0] + 1:]
+            opened = True
+            depth = 1
+        step = DEPTH_STEP[shape]
+        after = numpy.cumsum(step, dtype=numpy.int64) + depth
+        end = numpy.flatnonzero(after == 0)
+        if len(end):
+            closed = True
+            shape, step, after = shape[:end[0]], step[:end[0]], after[:end[0]]
+        commas += numpy.count_nonzero((shape == COMMA) & (after - step == 1))
+        nonempty = nonempty or bool(numpy.any(~BLANK[shape]))
+        if closed:
+            break
+        if len(after):
+            depth = after[-1]
+    if not closed or carry:
+        raise ValueError('Not a complete JSON array')
+    return int(commas) + 1 if nonempty else 0
+
+
+def paginate(url, count_only=False, session=None, limit=LIMIT):
+    '''
+    Generate the pages of a recentchanges list until it's exhausted, as
+    lists of changes, or with count_only just their lengths.
+
+    The API only pages by offset and has no timestamp cursor, so lists are
+    bounded by asking for a single day at a time.  If the server fails on a
+    page it's retried at half the page size, down to MIN_LIMIT, since heavy
+    days can time out.  A short page ends the list, so the count is exact
+    and the only extra request is when it's a multiple of the page size.
+    Raises IOError if a page can't be fetched.
+    '''
+    session = session or get_session()
+    offset = 0
+    while True:
+        params = {'offset': offset, 'limit' : limit}
+        # recentchanges lists are only cached briefly, see olclient.cachepolicy
+        response = session.get(url, params = params, stream = count_only)
+        if not response.ok:
+            if response.status_code >= 500 and limit > MIN_LIMIT:
+                limit = max(limit // 2, MIN_LIMIT)
+                continue
+            raise IOError('Failed to fetch url %d %s' % (response.status_code, response.url))
+        if count_only:
+            page = count_array(response.iter_content(CHUNK_SIZE))
+            size = page
+        else:
+            page = response.json()
+            size = len(page)
+        yield page
+        if size < limit: # short read means we're done
+            return
+        offset += size
+
+
+def day_url(date, kind):
+    return (CHANGES % (date.year, date.month, date.day)) + kind + '.json'
+
+
+def fetch_day(date, kind, session=None, count_only=True):
+    '''
+    Count the changes of `kind` on `date` by paging through the day's list.
+    Returns (count, ok) where ok is False if a request failed.
+
+    With count_only the pages are streamed through count_array rather than
+    being parsed into dicts which would only be counted.
+    '''
+    count = 0
+    try:
+        for page in paginate(day_url(date, kind), count_only, session):
+            count += page if count_only else len(page)
+    except IOError as e:
+        print(e)
+        return count, False
+    return count, True
+
+
+def changes_by_day(kind, start, end, workers=WORKERS, session=None):
+    '''
+    Generate (date, changes, ok) with all the changes of `kind` for each day
+    from end - 1 back to start, fetching days concurrently.  ok is False if
+    a request failed, in which case changes may be incomplete.
+    '''
+    def fetch(date):
+        changes = []
+        try:
+            for page in paginate(day_url(date, kind), session=session):
+                changes.extend(page)
+        except IOError as e:
+            print(e)
+            return date, changes, False
+        return date, changes, True
+
+    # Only a bounded number of days are fetched ahead of the consumer
+    days = sorted(daterange(start, end), reverse=True)
+    for result in ordered_map(fetch, days, workers):
+        yield result
+
+
+class SeriesStore(object):
+    '''
+    Daily change counts per kind, persisted in SQLite.  Days which weren't
+    final when counted are refetched by the next update.
+    '''
+    def __init__(self, filename=SERIES_DB):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(filename)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS counts ('
+                            'kind TEXT, day TEXT, count INTEGER, final INTEGER, '
+                            'PRIMARY KEY (kind, day))')
+
+    def final_days(self, kind):
+        return dict(self.db.execute('SELECT day, count FROM counts WHERE kind = ? AND final',
+                                    (kind,)))
+
+    def put(self, kind, date, count, final):
+        self.db.execute('INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?)',
+                        (kind, date.strftime('%Y-%m-%d'), count, int(final)))
+
+    def commit(self):
+        self.db.commit()
+
+    def read(self, kind, start=None, end=None):
+        '''
+        Return (dates, counts) NumPy arrays for the stored days of `kind`
+        from start up to (not including) end.
+        '''
+        start = start.strftime('%Y-%m-%d') if start else '0000'
+        end = end.strftime('%Y-%m-%d') if end else '9999'
+        rows = self.db.execute('SELECT day, count FROM counts WHERE kind = ? AND day >= ? AND day < ? '
+                               'ORDER BY day', (kind, start, end)).fetchall()
+        dates = numpy.array([day for day, _ in rows], dtype='datetime64[D]')
+        counts = numpy.array([count for _, count in rows], dtype=numpy.int64)
+        return dates, counts
+
+
+def crawl(kind, start, end, store=None, workers=WORKERS):
+    '''
+    Count `kind` for every day from start up to (not including) end which
+    isn't already final in the store, and record the counts there.
+    '''
+    store = store or SeriesStore()
+    final_before = datetime.datetime.today() - FINAL_AFTER
+    done = store.final_days(kind)
+    todo = [date for date in daterange(start, end) if date.strftime('%Y-%m-%d') not in done]
+    print('%s: %d days to fetch' % (kind, len(todo)))
+
+    def fetch(date):
+        return date, fetch_day(date, kind)
+
+    pool = ThreadPool(workers)
+    try:
+        for n, (date, (count, ok)) in enumerate(pool.imap_unordered(fetch, todo)):
+            if ok:
+                store.put(kind, date, count, date < final_before)
+            if n % SAVE_EVERY == SAVE_EVERY - 1:
+                store.commit()
+    finally:
+        pool.terminate()
+        pool.join()
+        store.commit()
+
+
+def update(kinds=None, store=None):
+    '''Bring the stored series for `kinds` (default all) up to date'''
+    store = store or SeriesStore()
+    end = datetime.datetime.combine(datetime.date.today(), datetime.time()) + datetime.timedelta(days=1)
+    for kind in kinds or sorted(SERIES):
+        start, stop = SERIES[kind]
+        crawl(kind, start, stop or end, store)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the stored recentchanges daily counts')
+    parser.add_argument('command', choices=['update'])
+    parser.add_argument('kinds', nargs='*', metavar='kind',
+                        help='kinds to update (default all): ' + ', '.join(sorted(SERIES)))
+    args = parser.parse_args()
+    for kind in args.kinds:
+        if kind not in SERIES:
+            parser.error('unknown kind %s' % kind)
+    update(args.kinds)
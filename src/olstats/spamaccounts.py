@@ -11,22 +11,22 @@ Created on 2015-09-02
 """
 
 from __future__ import print_function
-import requests
-import requests_cache
 from collections import Counter
+import datetime
+import os
+import sys
 
-requests_cache.install_cache('openlibrary_cache')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from spamindex import CHANGESETS_MAX, ChangesetExpander, SpamIndex, reversions
+from olclient import Stage, WORKERS, get_session, run_pipeline
 
-BASE='https://openlibrary.org'
-CHANGES = BASE + '/recentchanges'
-LIMIT=1000
- # As of Nov 2015, just over 7000 records
- # As of Nov 2018, 10K records goes back as far as 2014, so algorithm needs to be reworked
-MAX= 10000
+session = get_session()
+
+START = datetime.datetime(2011, 4, 20) # first day of the revert history
+END = datetime.datetime.today() + datetime.timedelta(days = 1)
 FETCH_CHANGESETS = True # True to fetch reverted change sets
 CHANGESET_SAMPLE = 1 # Select one of every SAMPLE records
-CHANGESETS_MAX = 10 # Only fetch first N changes of revert (ie last N to be reverted)
-FETCH_CHANGES = True
+FETCH_CHANGES = True # True to tally the documents changed by reverted change sets
 
 total_revert_count = 0
 sampled_revert_count = 0
@@ -34,32 +34,44 @@ changeset_count = 0
 changes_count = 0
 kinds = Counter() # kinds of changesets
 types = Counter() # types of changed documents (book, work, etc)
-for offset in range(0,MAX-LIMIT+1,LIMIT):
-    print('=============== %d ==================' % offset)
-    url = CHANGES + '/revert.json'
-    params = {'offset': offset, 'limit' : LIMIT}
-    # TODO: In production, don't use cache for recentchange list
-    response = requests.get(url, params = params)
-    if not response.ok:
-        print('Failed to fetch url %d %s' % (response.status_code, url))
-        continue
-    reversions = response.json()
-    
-    # process data
-    for reversion in reversions:
-        total_revert_count += 1
-        # Sample to get better temporal coverage
-        if total_revert_count % CHANGESET_SAMPLE != 0:
-            continue
-        sampled_revert_count += 1
-        changeset_count += len(reversion['data']['reverted_changesets'])
-        changelen = len(reversion['changes'])
-        key = reversion['changes'][max(-3,-1*changelen)]['key']
-        print('\t'.join((key,str(changelen),reversion['timestamp'])))
-    # Assume a short read means that we're done
-    if len(reversions) < LIMIT:
-        break
-        
+spammers = Counter() # reverted changesets per account
+index = SpamIndex() # persistent list of spammers, see spamindex.py
+expander = ChangesetExpander(session) # skips changesets already expanded
+failed = [] # days whose revert list couldn't be fetched
+
+
+def sample(reversion):
+    global total_revert_count
+    total_revert_count += 1
+    # Sample to get better temporal coverage
+    return [reversion] if total_revert_count % CHANGESET_SAMPLE == 0 else []
+
+
+def expand(reversion):
+    '''Fetch the reverted changesets of a reversion which haven't been seen before'''
+    return [(reversion, expander(reversion) if FETCH_CHANGESETS else [])]
+
+
+stages = [Stage('sample', sample),
+          Stage('changesets', expand, workers=WORKERS)]
+for reversion, changesets in run_pipeline(reversions(START, END, session, failed), stages):
+    sampled_revert_count += 1
+    changeset_count += len(reversion['data']['reverted_changesets'])
+    changelen = len(reversion['changes'])
+    key = reversion['changes'][max(-3,-1*changelen)]['key']
+    print('\t'.join((key,str(changelen),reversion['timestamp'])))
+    for changeset in changesets:
+        index.add(changeset)
+        kinds[changeset['kind']] += 1
+        if changeset.get('author'):
+            spammers[changeset['author']['key']] += 1
+        if FETCH_CHANGES:
+            changes_count += len(changeset['changes'])
+            # /books/OL1M -> books
+            types.update(change['key'].split('/')[1] for change in changeset['changes'])
+
+for date in sorted(failed):
+    print('** Incomplete revert list for %s' % date.strftime('%Y-%m-%d'))
 print('Processed %d of %d reversions (%2.1f%%) with %d changesets & %d changes (capped at %d per reversion)' % (sampled_revert_count, total_revert_count, (sampled_revert_count * 100.0) / total_revert_count, changeset_count, changes_count, CHANGESETS_MAX))
 print('Changeset kinds:')
 for (k, n) in kinds.most_common():
@@ -67,3 +79,11 @@ for (k, n) in kinds.most_common():
 print('Document types:')
 for (t, n) in types.most_common():
     print(t, n)
+index.commit()
+print('Spam accounts: %d (%d in index)' % (len(spammers), len(index)))
+for (account, n) in spammers.most_common(50):
+    print(account, n)
+for stage in stages:
+    print(stage.report())
+print(session.stats.report())
+print(session.policy.report())
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent index of spam accounts, i.e. the authors of reverted changesets.
+
+For each account the index keeps when it was first and last seen (the
+timestamps of its reverted changesets) and how many of its changesets were
+reverted.  Changeset ids are recorded too, so adding the same changeset
+again is a no-op and the index can be fed from overlapping crawls.
+Membership tests use an in memory set of the account keys.
+
+Add the reversions since the last update with:
+
+    python spamindex.py update
+
+@author: Tom Morris <tfmorris@gmail.com>
+@copyright 2015,2017 Thomas F. Morris
+"""
+
+from __future__ import print_function
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from recentchanges import BASE, FINAL_AFTER, SERIES, changes_by_day
+from olclient import CACHE_DIR, Stage, WORKERS, get_json, get_session, run_pipeline
+
+SPAM_DB = os.path.join(CACHE_DIR, 'spamaccounts.sqlite')
+CHANGESET = BASE + '/recentchanges/%s.json' # changesets never change, so they're cached for good
+CHANGESETS_MAX = 10 # Only fetch first N changes of revert (ie last N to be reverted)
+
+
+def get_changeset(changeset_id, session=None):
+    return get_json(CHANGESET % changeset_id, session)
+
+
+def reversions(start, end, session=None, failed=None):
+    '''
+    Generate the reversions from the revert lists of each day from end - 1
+    back to start.  Days whose list couldn't be fetched completely are
+    appended to `failed`.
+    '''
+    # Paging the global revert list back 10K records only reaches 2014, so walk it a day at a time
+    for date, day_reversions, ok in changes_by_day('revert', start, end, session=session):
+        if not ok and failed is not None:
+            failed.append(date)
+        for reversion in day_reversions:
+            yield reversion
+
+
+class ChangesetExpander(object):
+    '''
+    Fetch the reverted changesets of reversions, skipping any already seen
+    since they recur across reversions.  Safe to call from several threads.
+    '''
+    def __init__(self, session=None, seen=(), limit=CHANGESETS_MAX):
+        self.session = session
+        self.limit = limit
+        self.seen = set(seen) # changeset ids as strings
+        self.lock = threading.Lock()
+
+    def new_ids(self, reversion):
+        '''Return the ids of the reversion's first `limit` changesets not seen before'''
+        ids = [str(i) for i in reversion['data']['reverted_changesets'][:self.limit]]
+        with self.lock:
+            ids = [i for i in ids if i not in self.seen]
+            self.seen.update(ids)
+        return ids
+
+    def __call__(self, reversion):
+        changesets = (get_changeset(i, self.session) for i in self.new_ids(reversion))
+        return [c for c in changesets if c]
+
+
+class SpamIndex(object):
+    def __init__(self, filename=SPAM_DB):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(filename)
+        self._accounts = None # set of account keys, loaded on first use
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS accounts ('
+                            'account TEXT PRIMARY KEY, first_seen TEXT, last_seen TEXT, reverts INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS changesets (id TEXT PRIMARY KEY)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+
+    def __contains__(self, account):
+        if self._accounts is None:
+            self._accounts = set(row[0] for row in self.db.execute('SELECT account FROM accounts'))
+        return account in self._accounts
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM accounts').fetchone()[0]
+
+    def add(self, changeset):
+        '''
+        Record a reverted changeset against its author.  Returns False if it
+        was already in the index.
+        '''
+        if self.db.execute('INSERT OR IGNORE INTO changesets VALUES (?)', (str(changeset['id']),)).rowcount == 0:
+            return False
+        author = changeset.get('author')
+        if author:
+            account, timestamp = author['key'], changeset['timestamp']
+            self.db.execute('INSERT OR IGNORE INTO accounts VALUES (?, ?, ?, 0)', (account, timestamp, timestamp))
+            self.db.execute('UPDATE accounts SET first_seen = min(first_seen, ?), last_seen = max(last_seen, ?), '
+                            'reverts = reverts + 1 WHERE account = ?', (timestamp, timestamp, account))
+            if self._accounts is not None:
+                self._accounts.add(account)
+        return True
+
+    def commit(self):
+        self.db.commit()
+
+    def get(self, account):
+        '''Return (first_seen, last_seen, reverts) for an account, or None'''
+        return self.db.execute('SELECT first_seen, last_seen, reverts FROM accounts WHERE account = ?',
+                               (account,)).fetchone()
+
+    def first_seen_by_day(self):
+        '''Return (dates, counts) NumPy arrays of the number of accounts first seen each day'''
+        rows = self.db.execute('SELECT substr(first_seen, 1, 10) AS day, COUNT(*) FROM accounts '
+                               'GROUP BY day ORDER BY day').fetchall()
+        dates = numpy.array([day for day, _ in rows], dtype='datetime64[D]')
+        counts = numpy.array([count for _, count in rows], dtype=numpy.int64)
+        return dates, counts
+
+    def last_day(self):
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'last_day'").fetchone()
+        return datetime.datetime.strptime(row[0], '%Y-%m-%d') if row else None
+
+    def set_last_day(self, date):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('last_day', ?)", (date.strftime('%Y-%m-%d'),))
+
+
+def update(index=None, session=None, workers=WORKERS):
+    '''Add the reverted changesets from the revert lists of days since the last update'''
+    if index is None:
+        index = SpamIndex()
+    session = session or get_session()
+    start = index.last_day() or SERIES['revert'][0]
+    end = datetime.datetime.combine(datetime.date.today(), datetime.time()) + datetime.timedelta(days=1)
+    # SQLite connections can't be shared across threads, so workers check a snapshot of the known ids
+    expander = ChangesetExpander(session, (row[0] for row in index.db.execute('SELECT id FROM changesets')))
+    failed = [] # days whose revert list couldn't be fetched
+    stage = Stage('changesets', expander, workers=workers)
+    added = 0
+    for n, changeset in enumerate(run_pipeline(reversions(start, end, session, failed), [stage])):
+        added += index.add(changeset)
+        if n % 1000 == 999:
+            index.commit()
+    last_day = end - FINAL_AFTER - datetime.timedelta(days=1)
+    if failed:
+        # Start from the earliest failed day next time, so it isn't skipped for good
+        last_day = min(last_day, min(failed))
+        print('Failed to fetch the revert lists for %d days from %s' % (len(failed), min(failed).strftime('%Y-%m-%d')))
+    index.set_last_day(last_day)
+    index.commit()
+    print('Added %d reverted changesets, %d spam accounts' % (added, len(index)))
+    print(stage.report())
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['update']:
+        sys.exit('usage: spamindex.py update')
+    update()